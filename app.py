@@ -3,27 +3,69 @@ FastAPI приложение для управления пользовател
 Включает полный CRUD функционал для работы с базой данных.
 """
 
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, status
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
+from datetime import datetime
 import logging
+import orjson
 import db
+import cache
+from logging_setup import setup_logging, shutdown_logging
 from payments_api import payments_router
 
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+
+# Жизненный цикл приложения
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Подключение к базе данных и прогрев пула до приема запросов,
+    закрытие соединений при остановке приложения
+    """
+    try:
+        await db.connect_db()
+        await db.warm_up_pool()
+        db.start_user_batcher()
+        logger.info("База данных подключена успешно")
+        await cache.init_cache()
+    except Exception as e:
+        logger.error("Ошибка подключения к базе данных: %s", e)
+        raise
+    
+    yield
+    
+    try:
+        await db.stop_user_batcher()
+        await db.disconnect_db()
+        logger.info("Соединение с базой данных закрыто")
+        await cache.close_cache()
+    except Exception as e:
+        logger.error("Ошибка при закрытии соединения: %s", e)
+    finally:
+        shutdown_logging()
+
+
 app = FastAPI(
     title="User Management API",
     description="API для управления пользователями и их суб-аккаунтами",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Подключаем роутер для платежей
 app.include_router(payments_router)
 
+# Постраничная выдача списка пользователей
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+
 # Pydantic модели для валидации данных
 class UserCreate(BaseModel):
     sub_id: int
@@ -33,8 +75,8 @@ class UserResponse(BaseModel):
     id: int
     sub_ids: List[int]
     email: Optional[str]
-    created_at: str
-    updated_at: str
+    created_at: datetime
+    updated_at: datetime
 
 class SubAccountAdd(BaseModel):
     new_sub_id: int
@@ -46,26 +88,6 @@ class SuccessResponse(BaseModel):
     success: bool
     message: str
 
-# События приложения
-@app.on_event("startup")
-async def startup_event():
-    """Инициализация базы данных при запуске приложения"""
-    try:
-        await db.connect_db()
-        logger.info("База данных подключена успешно")
-    except Exception as e:
-        logger.error(f"Ошибка подключения к базе данных: {e}")
-        raise
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Закрытие соединения с базой данных при остановке приложения"""
-    try:
-        await db.disconnect_db()
-        logger.info("Соединение с базой данных закрыто")
-    except Exception as e:
-        logger.error(f"Ошибка при закрытии соединения: {e}")
-
 # Обработчики ошибок
 @app.exception_handler(ValueError)
 async def value_error_handler(request, exc):
@@ -81,6 +103,21 @@ async def runtime_error_handler(request, exc):
         content={"error": "Ошибка базы данных", "success": False}
     )
 
+@app.middleware("http")
+async def unhandled_error_handler(request, call_next):
+    # Единая обработка непредвиденных ошибок вместо try/except в каждом эндпоинте;
+    # ожидаемые ошибки передаются через HTTPException (например, PaymentError).
+    # Middleware, а не exception_handler(Exception): Starlette после такого обработчика
+    # пробрасывает исключение дальше, и uvicorn пишет тот же traceback второй раз
+    try:
+        return await call_next(request)
+    except Exception as exc:
+        logger.exception("Необработанная ошибка %s %s", request.method, request.url.path)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"error": f"Ошибка: {exc}", "success": False}
+        )
+
 # API эндпоинты
 
 @app.get("/", response_model=dict)
@@ -91,7 +128,7 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "user_management": {
-                "GET /users": "Получить всех пользователей",
+                "GET /users": "Получить пользователей (постранично: limit, offset)",
                 "GET /users/{user_id}": "Получить пользователя по ID",
                 "POST /users": "Создать нового пользователя",
                 "PUT /users/{user_id}/sub-accounts": "Добавить суб-аккаунт",
@@ -109,39 +146,71 @@ async def root():
         }
     }
 
-@app.get("/users", response_model=List[UserResponse])
-async def get_all_users():
+# Ответы читаются из БД и уже имеют нужную форму, поэтому повторная валидация
+# через response_model не выполняется; схема остается в OpenAPI через responses
+@app.get("/users", response_model=None, responses={200: {"model": List[UserResponse]}})
+async def get_all_users(
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0)
+):
     """
-    Получение списка всех пользователей
+    Получение списка пользователей, начиная с новых
+    
+    Args:
+        limit: Размер страницы
+        offset: Сколько пользователей пропустить
     
     Returns:
-        List[UserResponse]: Список всех пользователей
+        List[UserResponse]: Страница списка пользователей
     """
     try:
-        users = await db.get_all_users()
+        # Кешируется только первая страница стандартного размера
+        cacheable = limit == USERS_PAGE_SIZE and offset == 0
         
-        # Преобразуем datetime в строки для JSON сериализации
-        result = []
-        for user in users:
-            result.append(UserResponse(
-                id=user['id'],
-                sub_ids=user['sub_ids'],
-                email=user['email'],
-                created_at=user['created_at'].isoformat(),
-                updated_at=user['updated_at'].isoformat()
-            ))
+        # В кеше хранится готовый JSON: при попадании он отдается без сериализации
+        payload = await cache.get_bytes(cache.users_list_key()) if cacheable else None
+        if payload is None:
+            users = await db.get_all_users(limit, offset)
+            # Записи asyncpg превращаются в dict прямо в orjson (default=dict),
+            # datetime сериализуется напрямую, без ручного isoformat()
+            payload = orjson.dumps(users, default=dict)
+            if cacheable:
+                await cache.set_bytes(cache.users_list_key(), payload, cache.USERS_LIST_TTL)
+            logger.info("Получено %s пользователей", len(users))
         
-        logger.info(f"Получено {len(result)} пользователей")
-        return result
+        return Response(payload, media_type="application/json")
         
     except Exception as e:
-        logger.error(f"Ошибка получения пользователей: {e}")
+        logger.error("Ошибка получения пользователей: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка получения пользователей"
         )
 
-@app.get("/users/{user_id}", response_model=UserResponse)
+async def _get_user_json(user_id: int) -> bytes:
+    """
+    JSON пользователя из кеша или из БД (с сохранением в кеш)
+    
+    Raises:
+        HTTPException: Если пользователь не найден
+    """
+    payload = await cache.get_bytes(cache.user_key(user_id))
+    if payload is not None:
+        return payload
+    
+    user = await db.get_user(user_id)
+    
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Пользователь с ID {user_id} не найден"
+        )
+    
+    payload = orjson.dumps(user)
+    await cache.set_bytes(cache.user_key(user_id), payload, cache.USER_TTL)
+    return payload
+
+@app.get("/users/{user_id}", response_model=None, responses={200: {"model": UserResponse}})
 async def get_user(user_id: int):
     """
     Получение пользователя по ID
@@ -156,26 +225,12 @@ async def get_user(user_id: int):
         HTTPException: Если пользователь не найден
     """
     try:
-        user = await db.get_user(user_id)
-        
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Пользователь с ID {user_id} не найден"
-            )
-        
-        return UserResponse(
-            id=user['id'],
-            sub_ids=user['sub_ids'],
-            email=user['email'],
-            created_at=user['created_at'].isoformat(),
-            updated_at=user['updated_at'].isoformat()
-        )
+        return Response(await _get_user_json(user_id), media_type="application/json")
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка получения пользователя {user_id}: {e}")
+        logger.error("Ошибка получения пользователя %s: %s", user_id, e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка получения пользователя"
@@ -209,7 +264,8 @@ async def create_user(user_id: int, user_data: UserCreate):
                 detail=f"Пользователь с ID {user_id} уже существует"
             )
         
-        logger.info(f"Пользователь {user_id} создан успешно")
+        await cache.invalidate(cache.user_key(user_id), cache.users_list_key())
+        logger.info("Пользователь %s создан успешно", user_id)
         return SuccessResponse(
             success=True,
             message=f"Пользователь {user_id} создан успешно"
@@ -218,7 +274,7 @@ async def create_user(user_id: int, user_data: UserCreate):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка создания пользователя {user_id}: {e}")
+        logger.error("Ошибка создания пользователя %s: %s", user_id, e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка создания пользователя"
@@ -240,23 +296,21 @@ async def add_sub_account(user_id: int, sub_data: SubAccountAdd):
         HTTPException: Если пользователь не найден или суб-аккаунт уже существует
     """
     try:
-        success = await db.update_user_add_sub(user_id, sub_data.new_sub_id)
+        result = await db.update_user_add_sub(user_id, sub_data.new_sub_id)
         
-        if not success:
-            # Проверяем, существует ли пользователь
-            user = await db.get_user(user_id)
-            if not user:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Пользователь с ID {user_id} не найден"
-                )
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail=f"Суб-аккаунт {sub_data.new_sub_id} уже существует у пользователя {user_id}"
-                )
+        if result == db.AddSubResult.USER_NOT_FOUND:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Пользователь с ID {user_id} не найден"
+            )
+        if result == db.AddSubResult.ALREADY_EXISTS:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Суб-аккаунт {sub_data.new_sub_id} уже существует у пользователя {user_id}"
+            )
         
-        logger.info(f"Суб-аккаунт {sub_data.new_sub_id} добавлен пользователю {user_id}")
+        await cache.invalidate(cache.user_key(user_id), cache.users_list_key())
+        logger.info("Суб-аккаунт %s добавлен пользователю %s", sub_data.new_sub_id, user_id)
         return SuccessResponse(
             success=True,
             message=f"Суб-аккаунт {sub_data.new_sub_id} добавлен пользователю {user_id}"
@@ -265,7 +319,7 @@ async def add_sub_account(user_id: int, sub_data: SubAccountAdd):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка добавления суб-аккаунта {sub_data.new_sub_id} пользователю {user_id}: {e}")
+        logger.error("Ошибка добавления суб-аккаунта %s пользователю %s: %s", sub_data.new_sub_id, user_id, e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка добавления суб-аккаунта"
@@ -295,7 +349,8 @@ async def update_user_email(user_id: int, email_data: EmailUpdate):
                 detail=f"Пользователь с ID {user_id} не найден"
             )
         
-        logger.info(f"Email пользователя {user_id} обновлен на {email_data.email}")
+        await cache.invalidate(cache.user_key(user_id), cache.users_list_key())
+        logger.info("Email пользователя %s обновлен на %s", user_id, email_data.email)
         return SuccessResponse(
             success=True,
             message=f"Email пользователя {user_id} обновлен успешно"
@@ -304,7 +359,7 @@ async def update_user_email(user_id: int, email_data: EmailUpdate):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Ошибка обновления email пользователя {user_id}: {e}")
+        logger.error("Ошибка обновления email пользователя %s: %s", user_id, e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Ошибка обновления email"
@@ -317,13 +372,13 @@ async def get_user_legacy(user_id: int):
     """
     Legacy эндпоинт для получения пользователя (совместимость)
     """
-    user = await get_user(user_id)
+    user = orjson.loads(await _get_user_json(user_id))
     return {
-        "id": user.id,
-        "Sub-IDs": user.sub_ids,
-        "Email": user.email,
-        "Создан": user.created_at,
-        "Обновлен": user.updated_at
+        "id": user['id'],
+        "Sub-IDs": user['sub_ids'],
+        "Email": user['email'],
+        "Создан": user['created_at'],
+        "Обновлен": user['updated_at']
     }
 
 @app.post("/user-create/{user_id}")
@@ -339,7 +394,7 @@ async def add_card(user_id: int):
     """
     Эндпоинт для создания карты (заглушка)
     """
-    logger.info(f"Запрос на создание карты для пользователя {user_id}")
+    logger.info("Запрос на создание карты для пользователя %s", user_id)
     return {"user_id": user_id, "message": "card created"}
 
 @app.get("/user/{user_id}/cards")
@@ -347,6 +402,6 @@ async def get_cards(user_id: int):
     """
     Эндпоинт для получения карт пользователя (заглушка)
     """
-    logger.info(f"Запрос на получение карт пользователя {user_id}")
+    logger.info("Запрос на получение карт пользователя %s", user_id)
     return {"user_id": user_id, "cards": []}
 
@@ -7,6 +7,12 @@ import db  # твоя логика работы с БД
 
 from dotenv import load_dotenv
 
+# uvloop ускоряет цикл событий; на Windows он недоступен
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # загружаем переменные окружения
 load_dotenv()
 
@@ -30,4 +36,17 @@ async def start_cmd(message: Message):
     await message.answer(text="Привет! Перейди в веб-приложение, чтобы продолжить.")
 
 async def start_bot():
-    await dp.start_polling()
+    # пул БД нужен обработчикам (пакетная вставка пользователей пишет через него)
+    await db.connect_db()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await db.stop_user_batcher()
+        await db.disconnect_db()
+
+
+if __name__ == "__main__":
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(start_bot())
+
@@ -0,0 +1,165 @@
+"""
+Модуль кеширования ответов API в Redis.
+Если Redis не настроен или недоступен, кеш отключается и запросы идут в БД.
+"""
+
+import os
+import logging
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Безопасный импорт Redis
+REDIS_AVAILABLE = False
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    aioredis = None
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_PREFIX = "cf"
+
+# Время жизни записей кеша (секунды)
+USER_TTL = 30
+USERS_LIST_TTL = 5
+PAYMENT_BALANCE_TTL = 30
+PAYMENT_STATS_TTL = 300
+PAYMENT_TRANSACTIONS_TTL = 30
+
+# Глобальный клиент Redis
+client: Optional["aioredis.Redis"] = None
+
+
+def user_key(user_id: int) -> str:
+    """Ключ кеша для пользователя"""
+    return f"{CACHE_PREFIX}:user:{user_id}"
+
+
+def users_list_key() -> str:
+    """Ключ кеша для списка всех пользователей"""
+    return f"{CACHE_PREFIX}:users"
+
+
+def payment_balance_key(user_id: int) -> str:
+    """Ключ кеша для баланса пользователя"""
+    return f"{CACHE_PREFIX}:user:{user_id}:balance"
+
+
+def payment_stats_key(user_id: int) -> str:
+    """Ключ кеша для статистики платежей пользователя"""
+    return f"{CACHE_PREFIX}:user:{user_id}:stats"
+
+
+def payment_transactions_key(user_id: int) -> str:
+    """Ключ кеша для транзакций пользователя"""
+    return f"{CACHE_PREFIX}:user:{user_id}:transactions"
+
+
+def payment_keys(user_id: int) -> Tuple[str, ...]:
+    """Все ключи кеша платежных данных пользователя (для инвалидации при записи)"""
+    return (
+        payment_balance_key(user_id),
+        payment_stats_key(user_id),
+        payment_transactions_key(user_id),
+    )
+
+
+async def init_cache():
+    """
+    Подключение к Redis, если он настроен
+    """
+    global client
+
+    if not REDIS_AVAILABLE or not REDIS_URL:
+        logger.info("Кеш Redis не настроен, кеширование отключено")
+        return
+
+    client = aioredis.from_url(REDIS_URL)
+    logger.info("Кеш Redis подключен")
+
+
+async def close_cache():
+    """
+    Закрытие подключения к Redis
+    """
+    global client
+
+    if client:
+        await client.aclose()
+        client = None
+        logger.info("Подключение к Redis закрыто")
+
+
+async def get_bytes(key: str) -> Optional[bytes]:
+    """
+    Получение готового JSON из кеша
+
+    Returns:
+        Сериализованное значение или None при промахе/ошибке
+    """
+    if not client:
+        return None
+
+    try:
+        return await client.get(key)
+    except Exception as e:
+        logger.warning("Ошибка чтения кеша %s: %s", key, e)
+        return None
+
+
+async def set_bytes(key: str, payload: bytes, ttl: int):
+    """
+    Сохранение готового JSON в кеш на ttl секунд
+    """
+    if not client:
+        return
+
+    try:
+        await client.set(key, payload, ex=ttl)
+    except Exception as e:
+        logger.warning("Ошибка записи кеша %s: %s", key, e)
+
+
+async def get_or_set(key: str, ttl: int, loader: Callable[[], Awaitable[Any]]) -> bytes:
+    """
+    Получение JSON из кеша; при промахе значение строится loader,
+    сериализуется orjson и сохраняется на ttl секунд
+
+    Args:
+        key: Ключ кеша
+        ttl: Время жизни записи (секунды)
+        loader: Асинхронная функция, возвращающая значение для кеширования
+
+    Returns:
+        bytes: Сериализованное значение
+    """
+    payload = await get_bytes(key)
+    if payload is not None:
+        return payload
+
+    payload = orjson.dumps(await loader())
+    await set_bytes(key, payload, ttl)
+    return payload
+
+
+async def invalidate(*keys: str):
+    """
+    Удаление ключей из кеша
+    """
+    if not client or not keys:
+        return
+
+    try:
+        await client.delete(*keys)
+    except Exception as e:
+        logger.warning("Ошибка инвалидации кеша %s: %s", keys, e)
@@ -3,17 +3,18 @@
 Включает функции для управления пользователями и их суб-аккаунтами.
 """
 
+import asyncio
 import asyncpg
 import os
 import logging
+from enum import IntEnum
 from typing import Optional, List, Dict, Any
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Настройка логирования (обработчики настраивает приложение, см. logging_setup)
 logger = logging.getLogger(__name__)
 
 # Конфигурация базы данных
@@ -24,9 +25,116 @@ DATABASE_HOST = os.getenv("DATABASE_HOST", "localhost")
 DATABASE_PORT = os.getenv("DATABASE_PORT", "5432")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "CoinFlow")
 
+# Параметры пула соединений
+DATABASE_POOL_MIN_SIZE = int(os.getenv("DATABASE_POOL_MIN_SIZE", "10"))
+DATABASE_POOL_MAX_SIZE = int(os.getenv("DATABASE_POOL_MAX_SIZE", "50"))
+DATABASE_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DATABASE_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DATABASE_PING_INTERVAL = float(os.getenv("DATABASE_PING_INTERVAL", "30"))
+# Ограничения ожидания (секунды): выполнение запроса и получение соединения из пула,
+# чтобы при всплеске нагрузки запросы не ждали свободного соединения бесконечно
+DATABASE_COMMAND_TIMEOUT = float(os.getenv("DATABASE_COMMAND_TIMEOUT", "10"))
+DATABASE_ACQUIRE_TIMEOUT = float(os.getenv("DATABASE_ACQUIRE_TIMEOUT", "2"))
+
+# Подключение через PgBouncer в режиме transaction: подготовленные запросы живут
+# в серверной сессии, которая меняется между транзакциями, поэтому кеш
+# подготовленных запросов asyncpg отключается
+DATABASE_PGBOUNCER = os.getenv("DATABASE_PGBOUNCER", "").lower() in ("1", "true", "yes")
+
 # Глобальная переменная для пула соединений
 pool: Optional[asyncpg.Pool] = None
 
+# Фоновая задача проверки живости соединений пула
+_ping_task: Optional[asyncio.Task] = None
+
+# Параметры пакетной вставки пользователей из бота
+USER_BATCH_SIZE = 32
+USER_BATCH_WINDOW = 0.005  # секунды ожидания новых заявок перед записью пакета
+
+# Очередь заявок на создание пользователей и фоновая задача, которая их записывает
+_user_queue: Optional[asyncio.Queue] = None
+_user_batch_task: Optional[asyncio.Task] = None
+
+# Колонки пользователя; суб-аккаунты собираются из user_subs по первичному ключу
+USER_COLUMNS = """
+    u.id,
+    ARRAY(SELECT s.sub_id FROM user_subs s WHERE s.user_id = u.id ORDER BY s.sub_id) AS sub_ids,
+    u.email,
+    u.created_at,
+    u.updated_at
+"""
+
+# Запросы горячего пути. asyncpg подготавливает каждый запрос один раз на соединение
+# и переиспользует его из кеша (statement_cache_size), повторно подготавливая
+# после изменения схемы
+USER_QUERIES = {
+    'get_user': f"""
+        SELECT {USER_COLUMNS}
+        FROM users u
+        WHERE u.id = $1
+    """,
+    'create_user': """
+        WITH ins AS (
+            INSERT INTO users (id, email)
+            VALUES ($1, $3)
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        ), sub AS (
+            INSERT INTO user_subs (user_id, sub_id)
+            SELECT id, $2::bigint FROM ins
+        )
+        SELECT id FROM ins
+    """,
+    'add_sub': """
+        WITH u AS (
+            SELECT id FROM users WHERE id = $1
+        ), ins AS (
+            INSERT INTO user_subs (user_id, sub_id)
+            SELECT id, $2::bigint FROM u
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ), touch AS (
+            UPDATE users SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND EXISTS (SELECT 1 FROM ins)
+        )
+        SELECT CASE
+            WHEN EXISTS (SELECT 1 FROM ins) THEN 2
+            WHEN EXISTS (SELECT 1 FROM u) THEN 1
+            ELSE 0
+        END
+    """,
+    'update_email': """
+        UPDATE users 
+        SET email = $1 
+        WHERE id = $2
+        RETURNING id
+    """,
+}
+
+
+class AddSubResult(IntEnum):
+    """Результат добавления суб-аккаунта"""
+    USER_NOT_FOUND = 0
+    ALREADY_EXISTS = 1
+    ADDED = 2
+
+
+def get_database_url() -> str:
+    """
+    URL подключения к базе данных из переменных окружения
+    
+    Raises:
+        ValueError: Если не найдены необходимые переменные окружения
+    """
+    if DATABASE_URL:
+        # Используем полный URL подключения
+        return DATABASE_URL
+    
+    if not all([DATABASE_USERNAME, DATABASE_PASSWORD, DATABASE_HOST]):
+        raise ValueError("Необходимо указать DATABASE_URL или комбинацию DATABASE_USERNAME, DATABASE_PASSWORD, DATABASE_HOST")
+    
+    # Собираем URL из отдельных компонентов
+    return f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+
 
 async def connect_db() -> asyncpg.Pool:
     """
@@ -39,47 +147,65 @@ async def connect_db() -> asyncpg.Pool:
         ValueError: Если не найдены необходимые переменные окружения
         asyncpg.PostgresError: При ошибке подключения к БД
     """
-    global pool
+    global pool, _ping_task
     
-    if not DATABASE_URL and not all([DATABASE_USERNAME, DATABASE_PASSWORD, DATABASE_HOST]):
-        raise ValueError("Необходимо указать DATABASE_URL или комбинацию DATABASE_USERNAME, DATABASE_PASSWORD, DATABASE_HOST")
+    database_url = get_database_url()
     
     try:
-        if DATABASE_URL:
-            # Используем полный URL подключения
-            pool = await asyncpg.create_pool(
-                DATABASE_URL,
-                min_size=1,
-                max_size=10,
-                command_timeout=60
-            )
-        else:
-            # Собираем URL из отдельных компонентов
-            database_url = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
-            pool = await asyncpg.create_pool(
-                database_url,
-                min_size=1,
-                max_size=10,
-                command_timeout=60
-            )
+        pool = await asyncpg.create_pool(
+            database_url,
+            min_size=DATABASE_POOL_MIN_SIZE,
+            max_size=DATABASE_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DATABASE_POOL_MAX_INACTIVE_LIFETIME,
+            command_timeout=DATABASE_COMMAND_TIMEOUT,
+            statement_cache_size=0 if DATABASE_PGBOUNCER else 1024
+        )
         
         logger.info("Успешное подключение к базе данных PostgreSQL")
         
-        # Создаем таблицы при первом подключении
-        await create_tables()
+        _ping_task = asyncio.create_task(_ping_pool())
         
         return pool
         
     except Exception as e:
-        logger.error(f"Ошибка подключения к базе данных: {e}")
+        logger.error("Ошибка подключения к базе данных: %s", e)
         raise
 
 
+async def warm_up_pool():
+    """
+    Прогрев пула: все min_size соединений открываются и проверяются запросом,
+    чтобы первые запросы после старта не платили за установку соединения
+    
+    Raises:
+        RuntimeError: Если база данных не подключена
+    """
+    if not pool:
+        raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
+    
+    # Соединения удерживаются одновременно, чтобы прогреть разные, а не одно и то же
+    connections = await asyncio.gather(*[pool.acquire() for _ in range(pool.get_min_size())])
+    try:
+        await asyncio.gather(*[connection.fetchval("SELECT 1") for connection in connections])
+    finally:
+        await asyncio.gather(*[pool.release(connection) for connection in connections])
+    
+    logger.info("Пул соединений прогрет: %s соединений", len(connections))
+
+
 async def disconnect_db():
     """
     Закрытие подключения к базе данных
     """
-    global pool
+    global pool, _ping_task
+    
+    if _ping_task:
+        _ping_task.cancel()
+        try:
+            await _ping_task
+        except asyncio.CancelledError:
+            pass
+        _ping_task = None
     
     if pool:
         await pool.close()
@@ -87,51 +213,19 @@ async def disconnect_db():
         logger.info("Подключение к базе данных закрыто")
 
 
-async def create_tables():
+async def _ping_pool():
     """
-    Создание необходимых таблиц в базе данных
+    Периодическая проверка соединения с базой данных (аналог pool_pre_ping).
+    Соединения, разорванные сервером или сетью по простою, обнаруживаются
+    в фоне, а не на пути обработки запроса.
     """
-    if not pool:
-        raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
-    
-    async with pool.acquire() as connection:
-        # Создание таблицы users
-        await connection.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGINT PRIMARY KEY,
-                sub_ids BIGINT[] DEFAULT '{}',
-                email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Создание индекса для быстрого поиска по email
-        await connection.execute("""
-            CREATE INDEX IF NOT EXISTS idx_users_email ON users(email) WHERE email IS NOT NULL
-        """)
-        
-        # Создание функции для автоматического обновления updated_at
-        await connection.execute("""
-            CREATE OR REPLACE FUNCTION update_updated_at_column()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                NEW.updated_at = CURRENT_TIMESTAMP;
-                RETURN NEW;
-            END;
-            $$ language 'plpgsql'
-        """)
-        
-        # Создание триггера для автоматического обновления updated_at
-        await connection.execute("""
-            DROP TRIGGER IF EXISTS update_users_updated_at ON users;
-            CREATE TRIGGER update_users_updated_at
-                BEFORE UPDATE ON users
-                FOR EACH ROW
-                EXECUTE FUNCTION update_updated_at_column()
-        """)
-        
-        logger.info("Таблицы созданы успешно")
+    while True:
+        await asyncio.sleep(DATABASE_PING_INTERVAL)
+        try:
+            async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+                await connection.fetchval("SELECT 1")
+        except Exception as e:
+            logger.warning("Проверка соединения с базой данных не прошла: %s", e)
 
 
 async def create_user(id: int, sub_id: int, email: Optional[str] = None) -> bool:
@@ -154,34 +248,23 @@ async def create_user(id: int, sub_id: int, email: Optional[str] = None) -> bool
         raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
     
     try:
-        async with pool.acquire() as connection:
-            # Проверяем, существует ли пользователь
-            existing_user = await connection.fetchrow(
-                "SELECT id FROM users WHERE id = $1", id
-            )
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            # Создаем пользователя одним запросом: при конфликте по id ничего не вставляется
+            row = await connection.fetchrow(USER_QUERIES['create_user'], id, sub_id, email)
             
-            if existing_user:
-                logger.warning(f"Пользователь с ID {id} уже существует")
+            if row is None:
+                logger.warning("Пользователь с ID %s уже существует", id)
                 return False
             
-            # Создаем нового пользователя
-            await connection.execute("""
-                INSERT INTO users (id, sub_ids, email)
-                VALUES ($1, $2, $3)
-            """, id, [sub_id], email)
-            
-            logger.info(f"Пользователь {id} создан успешно с суб-аккаунтом {sub_id}")
+            logger.debug("Пользователь %s создан успешно с суб-аккаунтом %s", id, sub_id)
             return True
             
-    except asyncpg.UniqueViolationError:
-        logger.warning(f"Пользователь с ID {id} уже существует")
-        return False
     except Exception as e:
-        logger.error(f"Ошибка создания пользователя {id}: {e}")
+        logger.error("Ошибка создания пользователя %s: %s", id, e)
         raise
 
 
-async def update_user_add_sub(id: int, new_sub_id: int) -> bool:
+async def update_user_add_sub(id: int, new_sub_id: int) -> AddSubResult:
     """
     Добавление нового суб-аккаунта пользователю
     
@@ -190,7 +273,8 @@ async def update_user_add_sub(id: int, new_sub_id: int) -> bool:
         new_sub_id: ID нового суб-аккаунта
         
     Returns:
-        bool: True если суб-аккаунт добавлен успешно, False если пользователь не найден
+        AddSubResult: ADDED если суб-аккаунт добавлен, ALREADY_EXISTS если он уже
+        есть у пользователя, USER_NOT_FOUND если пользователь не найден
         
     Raises:
         RuntimeError: Если база данных не подключена
@@ -200,35 +284,21 @@ async def update_user_add_sub(id: int, new_sub_id: int) -> bool:
         raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
     
     try:
-        async with pool.acquire() as connection:
-            # Проверяем, существует ли пользователь
-            user = await connection.fetchrow(
-                "SELECT sub_ids FROM users WHERE id = $1", id
-            )
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            # Добавляем суб-аккаунт и сразу получаем причину отказа одним запросом
+            result = AddSubResult(await connection.fetchval(USER_QUERIES['add_sub'], id, new_sub_id))
             
-            if not user:
-                logger.warning(f"Пользователь с ID {id} не найден")
-                return False
-            
-            # Проверяем, не существует ли уже такой суб-аккаунт
-            current_sub_ids = user['sub_ids'] or []
-            if new_sub_id in current_sub_ids:
-                logger.warning(f"Суб-аккаунт {new_sub_id} уже существует у пользователя {id}")
-                return False
+            if result == AddSubResult.USER_NOT_FOUND:
+                logger.warning("Пользователь с ID %s не найден", id)
+            elif result == AddSubResult.ALREADY_EXISTS:
+                logger.warning("Суб-аккаунт %s уже существует у пользователя %s", new_sub_id, id)
+            else:
+                logger.debug("Суб-аккаунт %s добавлен пользователю %s", new_sub_id, id)
             
-            # Добавляем новый суб-аккаунт
-            new_sub_ids = current_sub_ids + [new_sub_id]
-            await connection.execute("""
-                UPDATE users 
-                SET sub_ids = $1 
-                WHERE id = $2
-            """, new_sub_ids, id)
-            
-            logger.info(f"Суб-аккаунт {new_sub_id} добавлен пользователю {id}")
-            return True
+            return result
             
     except Exception as e:
-        logger.error(f"Ошибка добавления суб-аккаунта {new_sub_id} пользователю {id}: {e}")
+        logger.error("Ошибка добавления суб-аккаунта %s пользователю %s: %s", new_sub_id, id, e)
         raise
 
 
@@ -251,28 +321,19 @@ async def update_user_email(id: int, email: str) -> bool:
         raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
     
     try:
-        async with pool.acquire() as connection:
-            # Проверяем, существует ли пользователь
-            user = await connection.fetchrow(
-                "SELECT id FROM users WHERE id = $1", id
-            )
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            # Обновляем email; отсутствие строки в RETURNING означает, что пользователя нет
+            row = await connection.fetchrow(USER_QUERIES['update_email'], email, id)
             
-            if not user:
-                logger.warning(f"Пользователь с ID {id} не найден")
+            if row is None:
+                logger.warning("Пользователь с ID %s не найден", id)
                 return False
             
-            # Обновляем email
-            await connection.execute("""
-                UPDATE users 
-                SET email = $1 
-                WHERE id = $2
-            """, email, id)
-            
-            logger.info(f"Email пользователя {id} обновлен на {email}")
+            logger.debug("Email пользователя %s обновлен на %s", id, email)
             return True
             
     except Exception as e:
-        logger.error(f"Ошибка обновления email пользователя {id}: {e}")
+        logger.error("Ошибка обновления email пользователя %s: %s", id, e)
         raise
 
 
@@ -294,36 +355,31 @@ async def get_user(id: int) -> Optional[Dict[str, Any]]:
         raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
     
     try:
-        async with pool.acquire() as connection:
-            user = await connection.fetchrow("""
-                SELECT id, sub_ids, email, created_at, updated_at
-                FROM users 
-                WHERE id = $1
-            """, id)
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            user = await connection.fetchrow(USER_QUERIES['get_user'], id)
             
             if not user:
-                logger.info(f"Пользователь с ID {id} не найден")
+                logger.debug("Пользователь с ID %s не найден", id)
                 return None
             
-            return {
-                'id': user['id'],
-                'sub_ids': user['sub_ids'] or [],
-                'email': user['email'],
-                'created_at': user['created_at'],
-                'updated_at': user['updated_at']
-            }
+            return dict(user)
             
     except Exception as e:
-        logger.error(f"Ошибка получения пользователя {id}: {e}")
+        logger.error("Ошибка получения пользователя %s: %s", id, e)
         raise
 
 
-async def get_all_users() -> List[Dict[str, Any]]:
+async def get_all_users(limit: Optional[int] = None, offset: int = 0) -> List[asyncpg.Record]:
     """
-    Получение списка всех пользователей
+    Получение списка пользователей, начиная с новых
     
+    Args:
+        limit: Максимальное количество пользователей (None - без ограничения)
+        offset: Сколько пользователей пропустить
+        
     Returns:
-        List[Dict]: Список всех пользователей
+        List[asyncpg.Record]: Список всех пользователей (записи поддерживают
+        доступ по ключу; для orjson.dumps используйте default=dict)
         
     Raises:
         RuntimeError: Если база данных не подключена
@@ -333,31 +389,201 @@ async def get_all_users() -> List[Dict[str, Any]]:
         raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
     
     try:
-        async with pool.acquire() as connection:
-            users = await connection.fetch("""
-                SELECT id, sub_ids, email, created_at, updated_at
-                FROM users 
-                ORDER BY created_at DESC
-            """)
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            users = await connection.fetch(f"""
+                SELECT {USER_COLUMNS}
+                FROM users u
+                ORDER BY u.created_at DESC
+                LIMIT $1 OFFSET $2
+            """, limit, offset)
             
-            result = []
-            for user in users:
-                result.append({
-                    'id': user['id'],
-                    'sub_ids': user['sub_ids'] or [],
-                    'email': user['email'],
-                    'created_at': user['created_at'],
-                    'updated_at': user['updated_at']
-                })
+            logger.debug("Получено %s пользователей", len(users))
+            return users
             
-            logger.info(f"Получено {len(result)} пользователей")
-            return result
+    except Exception as e:
+        logger.error("Ошибка получения всех пользователей: %s", e)
+        raise
+
+
+async def create_users_bulk(users: List[tuple]) -> None:
+    """
+    Массовое создание пользователей; существующие ID пропускаются
+    
+    Args:
+        users: Список кортежей (id, sub_id, email)
+        
+    Raises:
+        RuntimeError: Если база данных не подключена
+        asyncpg.PostgresError: При ошибке выполнения запроса
+    """
+    if not pool:
+        raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
+    
+    try:
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            await connection.executemany(USER_QUERIES['create_user'], users)
+            
+            logger.info("Массовое создание: обработано %s пользователей", len(users))
             
     except Exception as e:
-        logger.error(f"Ошибка получения всех пользователей: {e}")
+        logger.error("Ошибка массового создания пользователей: %s", e)
         raise
 
 
+async def get_users_bulk(ids: List[int]) -> List[asyncpg.Record]:
+    """
+    Получение данных нескольких пользователей за один обмен с сервером
+    
+    Args:
+        ids: Список ID пользователей
+        
+    Returns:
+        List[asyncpg.Record]: Найденные пользователи (отсутствующие ID пропускаются)
+        
+    Raises:
+        RuntimeError: Если база данных не подключена
+        asyncpg.PostgresError: При ошибке выполнения запроса
+    """
+    if not pool:
+        raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
+    
+    try:
+        async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+            return await connection.fetchmany(
+                USER_QUERIES['get_user'], [(id,) for id in ids]
+            )
+            
+    except Exception as e:
+        logger.error("Ошибка массового получения пользователей: %s", e)
+        raise
+
+
+async def _insert_users_batch(ids: List[int]) -> set:
+    """
+    Вставка пакета пользователей одним запросом
+    
+    Args:
+        ids: Список ID пользователей из Telegram
+        
+    Returns:
+        set: ID пользователей, которые были созданы (без уже существующих)
+    """
+    if not pool:
+        raise RuntimeError("База данных не подключена. Вызовите connect_db() сначала.")
+    
+    async with pool.acquire(timeout=DATABASE_ACQUIRE_TIMEOUT) as connection:
+        rows = await connection.fetch("""
+            INSERT INTO users (id)
+            SELECT * FROM unnest($1::bigint[])
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        """, ids)
+    
+    return {row['id'] for row in rows}
+
+
+async def _user_batch_worker():
+    """
+    Фоновая задача: собирает заявки из очереди в пакеты до USER_BATCH_SIZE штук
+    (или пока не истечет USER_BATCH_WINDOW) и записывает их одним запросом
+    """
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await _user_queue.get()]
+        deadline = loop.time() + USER_BATCH_WINDOW
+        
+        try:
+            while len(batch) < USER_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_user_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            created = await _insert_users_batch(list({user_id for user_id, _ in batch}))
+            
+            for user_id, future in batch:
+                if not future.done():
+                    future.set_result(user_id in created)
+        except Exception as e:
+            logger.error("Ошибка пакетной вставки %s пользователей: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Если задачу отменили во время сбора пакета или вставки, заявки, уже
+            # взятые из очереди, отменяются, иначе ожидающие их вызовы зависнут навсегда
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+
+def start_user_batcher():
+    """
+    Запуск фоновой задачи пакетной вставки пользователей
+    """
+    global _user_queue, _user_batch_task
+    
+    if _user_batch_task and not _user_batch_task.done():
+        return
+    
+    _user_queue = asyncio.Queue()
+    _user_batch_task = asyncio.create_task(_user_batch_worker())
+    logger.info("Пакетная вставка пользователей запущена")
+
+
+async def stop_user_batcher():
+    """
+    Остановка фоновой задачи пакетной вставки пользователей
+    """
+    global _user_queue, _user_batch_task
+    
+    if not _user_batch_task:
+        return
+    
+    _user_batch_task.cancel()
+    try:
+        await _user_batch_task
+    except asyncio.CancelledError:
+        pass
+    
+    # Отменяем заявки, которые не успели попасть в пакет
+    while not _user_queue.empty():
+        _, future = _user_queue.get_nowait()
+        if not future.done():
+            future.cancel()
+    
+    _user_queue = None
+    _user_batch_task = None
+    logger.info("Пакетная вставка пользователей остановлена")
+
+
+async def add_user_if_not_exists(user: Dict[str, Any]) -> bool:
+    """
+    Создание пользователя из бота, если его еще нет.
+    Заявка ставится в очередь и записывается в БД вместе с соседними.
+    
+    Args:
+        user: Данные пользователя из Telegram (id, username, phone)
+        
+    Returns:
+        bool: True если пользователь создан, False если уже существовал
+        
+    Raises:
+        RuntimeError: Если база данных не подключена
+        asyncpg.PostgresError: При ошибке выполнения запроса
+    """
+    if not _user_batch_task:
+        start_user_batcher()
+    
+    future = asyncio.get_running_loop().create_future()
+    await _user_queue.put((user['id'], future))
+    return await future
+
+
 # Пример использования
 async def main():
     """Пример использования функций базы данных"""
@@ -370,8 +596,8 @@ async def main():
         print(f"Создание пользователя: {success}")
         
         # Добавление суб-аккаунта
-        success = await update_user_add_sub(123456789, 111222333)
-        print(f"Добавление суб-аккаунта: {success}")
+        result = await update_user_add_sub(123456789, 111222333)
+        print(f"Добавление суб-аккаунта: {result.name}")
         
         # Обновление email
         success = await update_user_email(123456789, "newemail@example.com")
@@ -381,6 +607,14 @@ async def main():
         user = await get_user(123456789)
         print(f"Данные пользователя: {user}")
         
+        # Массовое создание и получение пользователей
+        await create_users_bulk([
+            (987654321, 123456789, "user2@example.com"),
+            (555666777, 111222333, "user3@example.com"),
+        ])
+        users = await get_users_bulk([987654321, 555666777])
+        print(f"Массово получено пользователей: {len(users)}")
+        
         # Получение всех пользователей
         all_users = await get_all_users()
         print(f"Всего пользователей: {len(all_users)}")
@@ -393,6 +627,6 @@ async def main():
 
 
 if __name__ == "__main__":
-    import asyncio
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
 
@@ -0,0 +1,95 @@
+"""
+Настройка логирования приложения.
+Записи передаются через очередь в отдельный поток (QueueHandler/QueueListener),
+где форматируются и выводятся, поэтому логирование не блокирует цикл событий.
+"""
+
+import os
+import queue
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Optional
+
+import orjson
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Конфигурация
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+DB_LOG_LEVEL = os.getenv("DB_LOG_LEVEL", LOG_LEVEL).upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text или json
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# Поток, который пишет записи из очереди в stderr
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирование записи лога в одну строку JSON для агрегаторов"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(data).decode()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает запись в очередь как есть. Стандартный QueueHandler форматирует
+    сообщение в вызывающем потоке и переносит traceback в msg; здесь сообщение
+    и exc_info собирает форматтер в потоке QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging():
+    """
+    Настройка корневого логгера: уровень из LOG_LEVEL, вывод через очередь.
+    Уровень логгера модуля db задается отдельно через DB_LOG_LEVEL
+    (например, WARNING в production).
+    """
+    global _listener
+
+    if _listener:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    logging.getLogger("db").setLevel(DB_LOG_LEVEL)
+
+
+def shutdown_logging():
+    """
+    Остановка потока логирования с выводом оставшихся записей
+    """
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
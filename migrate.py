@@ -0,0 +1,73 @@
+"""
+Применение миграций схемы базы данных из каталога migrations/.
+Запуск: python migrate.py
+
+Каждый файл *.sql применяется один раз в отдельной транзакции;
+примененные миграции записываются в таблицу schema_migrations.
+"""
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import List
+
+import asyncpg
+
+import db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent / "migrations"
+
+
+async def apply_migrations(connection: asyncpg.Connection) -> List[str]:
+    """
+    Применение еще не примененных миграций по порядку имен файлов
+
+    Args:
+        connection: Соединение с базой данных
+
+    Returns:
+        List[str]: Имена примененных миграций
+    """
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    rows = await connection.fetch("SELECT name FROM schema_migrations")
+    already_applied = {row['name'] for row in rows}
+
+    applied = []
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        if path.name in already_applied:
+            continue
+
+        async with connection.transaction():
+            await connection.execute(path.read_text(encoding="utf-8"))
+            await connection.execute(
+                "INSERT INTO schema_migrations (name) VALUES ($1)", path.name
+            )
+
+        logger.info("Миграция %s применена", path.name)
+        applied.append(path.name)
+
+    return applied
+
+
+async def main():
+    """Подключение к базе данных и применение миграций"""
+    connection = await asyncpg.connect(db.get_database_url())
+    try:
+        applied = await apply_migrations(connection)
+        if not applied:
+            logger.info("Схема базы данных актуальна")
+    finally:
+        await connection.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
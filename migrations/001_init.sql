@@ -0,0 +1,43 @@
+-- Начальная схема: пользователи, их суб-аккаунты и автообновление updated_at
+
+-- Таблица пользователей
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT PRIMARY KEY,
+    sub_ids BIGINT[] DEFAULT '{}',
+    email TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Таблица суб-аккаунтов: добавление - это вставка одной строки,
+-- поиск суб-аккаунтов пользователя идет по первичному ключу (user_id, sub_id)
+CREATE TABLE IF NOT EXISTS user_subs (
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    sub_id BIGINT NOT NULL,
+    PRIMARY KEY (user_id, sub_id)
+);
+
+-- Перенос суб-аккаунтов из устаревшей колонки users.sub_ids
+INSERT INTO user_subs (user_id, sub_id)
+SELECT id, unnest(sub_ids) FROM users
+WHERE NOT EXISTS (SELECT 1 FROM user_subs)
+ON CONFLICT DO NOTHING;
+
+-- Индекс для быстрого поиска по email
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email) WHERE email IS NOT NULL;
+
+-- Функция для автоматического обновления updated_at
+CREATE OR REPLACE FUNCTION update_updated_at_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+-- Триггер для автоматического обновления updated_at
+DROP TRIGGER IF EXISTS update_users_updated_at ON users;
+CREATE TRIGGER update_users_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
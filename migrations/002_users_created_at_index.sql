@@ -0,0 +1,5 @@
+-- Покрывающий индекс для списка пользователей (ORDER BY created_at DESC):
+-- постраничная выборка читается из индекса без сортировки и обращения к таблице.
+-- Суб-аккаунты хранятся в user_subs, поэтому sub_ids в индекс не входит.
+CREATE INDEX IF NOT EXISTS idx_users_created_at
+    ON users (created_at DESC) INCLUDE (id, email, updated_at);
@@ -0,0 +1,3 @@
+-- Суб-аккаунты перенесены в user_subs (001_init.sql), устаревшая колонка
+-- users.sub_ids больше не пишется и не читается
+ALTER TABLE users DROP COLUMN IF EXISTS sub_ids;
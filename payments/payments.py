@@ -4,11 +4,19 @@
 """
 
 import os
+import sys
+import asyncio
+import bisect
+import functools
+import threading
 import uuid
-import json
+import orjson
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
-from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
 from enum import Enum
 
 from dotenv import load_dotenv
@@ -26,6 +34,16 @@ except ImportError:
     stripe = None
     STRIPE_AVAILABLE = False
 
+# Безопасный импорт фильтра Блума (поиск дублей транзакций)
+BLOOM_AVAILABLE = False
+
+try:
+    from pybloom_live import BloomFilter
+    BLOOM_AVAILABLE = True
+except ImportError:
+    BloomFilter = None
+    BLOOM_AVAILABLE = False
+
 
 # Конфигурация
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
@@ -60,75 +78,371 @@ class TransactionStatus(Enum):
     CANCELLED = "cancelled"
 
 
-@dataclass
+# Комиссия Stripe: 2.9% + $0.30, в целочисленном виде (промилле и центы)
+_STRIPE_RATE_PERMILLE = 29
+_STRIPE_FLAT_CENTS = 30
+
+# Члены перечислений для горячих путей (без поиска атрибута Enum на каждый вызов)
+_TT_DEPOSIT = TransactionType.STRIPE_DEPOSIT
+_TS_PENDING = TransactionStatus.PENDING
+_TS_FAILED = TransactionStatus.FAILED
+
+# Значение из журнала -> член перечисления (прямой поиск в словаре при загрузке)
+_TYPE_MAP = {t.value: t for t in TransactionType}
+_STATUS_MAP = {s.value: s for s in TransactionStatus}
+
+# Ответ методов StripePayments, когда Stripe не инициализирован
+_STRIPE_UNINIT_RESULT = {
+    'success': False,
+    'error': 'Stripe API не инициализирован'
+}
+
+# Поиск дублей: пара фильтров Блума (активный и предыдущий) по ключам транзакций
+_DEDUP_CAPACITY = 65536
+_DEDUP_ERROR_RATE = 0.001
+
+
+def to_cents(amount: float) -> int:
+    """Перевод суммы в долларах в целые центы"""
+    return round(amount * 100)
+
+
+def from_cents(cents: int) -> float:
+    """Перевод целых центов в сумму в долларах (только для вывода)"""
+    return cents / 100
+
+
+@dataclass(slots=True)
 class Transaction:
-    """Модель транзакции для Ledger"""
+    """Модель транзакции для Ledger (суммы в целых центах)"""
     id: str
     user_id: str
     type: TransactionType
-    gross: float
-    net: float
-    fee: float
+    gross: int
+    net: int
+    fee: int
     status: TransactionStatus
     timestamp: datetime
     metadata: Optional[Dict] = None
 
     def to_dict(self) -> Dict:
         """Преобразование в словарь для сериализации"""
-        data = asdict(self)
-        data['type'] = self.type.value
-        data['status'] = self.status.value
-        data['timestamp'] = self.timestamp.isoformat()
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'type': self.type.value,
+            'gross': self.gross,
+            'net': self.net,
+            'fee': self.fee,
+            'status': self.status.value,
+            'timestamp': self.timestamp.isoformat(),
+            'metadata': self.metadata
+        }
+    
+    def to_public_dict(self) -> Dict:
+        """Преобразование в словарь для ответа API (суммы в долларах)"""
+        data = self.to_dict()
+        data['gross'] = from_cents(self.gross)
+        data['net'] = from_cents(self.net)
+        data['fee'] = from_cents(self.fee)
         return data
 
 
+def _locked(method):
+    """Выполнение метода Ledger под его блокировкой (вызовы из разных потоков)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Ledger:
-    """Класс для ведения учёта всех транзакций"""
+    """
+    Класс для ведения учёта всех транзакций.
+    
+    Хранилище - журнал JSONL только для дозаписи: каждая новая транзакция
+    добавляется одной строкой, смена статуса - отдельной строкой-дельтой
+    {"op": "status", "id": ..., "status": ...}. При загрузке дельты
+    применяются к транзакциям; когда их накапливается больше compact_threshold,
+    журнал переписывается снимком текущего состояния (compact).
+    
+    Изменения выполняются под блокировкой, поэтому Ledger можно вызывать из
+    потоков (например, из asyncio.to_thread в обработчиках API).
+    
+    Несколько изменений подряд можно объединить в одну запись на диск:
     
-    def __init__(self, storage_file: str = "transactions.json"):
+        with ledger.batch():
+            transaction_id = ledger.log_transaction(...)
+            ledger.update_transaction_status(transaction_id, ...)
+    """
+    
+    def __init__(self, storage_file: str = "transactions.jsonl", compact_threshold: int = 1000):
         self.storage_file = storage_file
+        self.compact_threshold = compact_threshold
         self.transactions: List[Transaction] = []
+        # Индексы для выборок без полного перебора self.transactions
+        # Транзакции пользователя упорядочены по времени; _by_user_ts - их метки
+        # времени в том же порядке для выборок по интервалу через bisect
+        self._by_user: Dict[str, List[Transaction]] = defaultdict(list)
+        self._by_user_ts: Dict[str, List[datetime]] = defaultdict(list)
+        self._by_id: Dict[str, Transaction] = {}
+        # Агрегаты по пользователю, обновляемые при каждом изменении (для баланса за O(1))
+        self._aggregates: Dict[str, Dict] = defaultdict(
+            lambda: {'deposits': 0, 'transfers_out': 0, 'count': 0}
+        )
+        # Число транзакций и сумма gross (в центах) по статусам: user_id -> status -> [count, gross]
+        self._status_totals: Dict[str, Dict[str, List[int]]] = defaultdict(dict)
+        # Ключи дедупликации (например, payment_intent_id): [активный, предыдущий] фильтр
+        self._dedup = [self._new_dedup_filter(), self._new_dedup_filter()]
+        self._delta_count = 0
+        self._file = None
+        # Строки журнала, отложенные внутри batch() до выхода из блока
+        self._batch_depth = 0
+        self._pending: List[bytes] = []
+        self._lock = threading.RLock()
         self._load_transactions()
     
     def _load_transactions(self):
-        """Загрузка транзакций из файла"""
-        if os.path.exists(self.storage_file):
-            try:
-                with open(self.storage_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for item in data:
-                        transaction = Transaction(
-                            id=item['id'],
-                            user_id=item['user_id'],
-                            type=TransactionType(item['type']),
-                            gross=item['gross'],
-                            net=item['net'],
-                            fee=item['fee'],
-                            status=TransactionStatus(item['status']),
-                            timestamp=datetime.fromisoformat(item['timestamp']),
-                            metadata=item.get('metadata')
-                        )
-                        self.transactions.append(transaction)
-            except Exception as e:
-                print(f"Ошибка загрузки транзакций: {e}")
-    
-    def _save_transactions(self):
-        """Сохранение транзакций в файл"""
+        """Загрузка транзакций из журнала с применением дельт статусов"""
+        if not os.path.exists(self.storage_file):
+            self._import_legacy_json()
+            return
+        
+        # Разобранные метки времени за время загрузки (совпадают у записей одной сессии)
+        timestamps: Dict[str, datetime] = {}
+        try:
+            with open(self.storage_file, 'rb') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        item = orjson.loads(line)
+                    except orjson.JSONDecodeError as e:
+                        # Например, оборванная последняя строка после сбоя
+                        print(f"Пропущена поврежденная строка {line_number} журнала транзакций: {e}")
+                        continue
+                    
+                    if item.get('op') == 'status':
+                        transaction = self._by_id.get(item['id'])
+                        if transaction:
+                            self._set_status(transaction, _STATUS_MAP[item['status']])
+                        self._delta_count += 1
+                    else:
+                        self._add(self._transaction_from_dict(item, timestamps))
+        except Exception as e:
+            print(f"Ошибка загрузки транзакций: {e}")
+    
+    def _import_legacy_json(self):
+        """Перенос транзакций из прежнего формата (JSON-массив в .json файле)"""
+        legacy_file = os.path.splitext(self.storage_file)[0] + '.json'
+        if legacy_file == self.storage_file or not os.path.exists(legacy_file):
+            return
+        
+        try:
+            with open(legacy_file, 'rb') as f:
+                data = orjson.loads(f.read())
+            timestamps: Dict[str, datetime] = {}
+            for item in data:
+                self._add(self._transaction_from_dict(item, timestamps))
+            self.compact()
+        except Exception as e:
+            print(f"Ошибка переноса транзакций из {legacy_file}: {e}")
+    
+    def _add(self, transaction: Transaction):
+        """Добавление транзакции в память и в индексы"""
+        self.transactions.append(transaction)
+        user_transactions = self._by_user[transaction.user_id]
+        user_timestamps = self._by_user_ts[transaction.user_id]
+        if not user_timestamps or user_timestamps[-1] <= transaction.timestamp:
+            user_transactions.append(transaction)
+            user_timestamps.append(transaction.timestamp)
+        else:
+            # Запись не по порядку времени (например, после перевода часов)
+            index = bisect.bisect_right(user_timestamps, transaction.timestamp)
+            user_transactions.insert(index, transaction)
+            user_timestamps.insert(index, transaction.timestamp)
+        self._by_id[transaction.id] = transaction
+        self._aggregates[transaction.user_id]['count'] += 1
+        self._apply_to_aggregates(transaction, 1)
+        if transaction.metadata and 'dedup_key' in transaction.metadata:
+            self._remember_dedup_key(transaction.metadata['dedup_key'])
+    
+    def _set_status(self, transaction: Transaction, status: TransactionStatus):
+        """Смена статуса с пересчетом агрегатов"""
+        self._apply_to_aggregates(transaction, -1)
+        transaction.status = status
+        self._apply_to_aggregates(transaction, 1)
+    
+    def _apply_to_aggregates(self, transaction: Transaction, sign: int):
+        """
+        Учет (sign=1) или исключение (sign=-1) транзакции из агрегатов:
+        итогов по ее статусу и, для завершенных, сумм пополнений и переводов
+        """
+        totals = self._status_totals[transaction.user_id].setdefault(transaction.status.value, [0, 0])
+        totals[0] += sign
+        totals[1] += sign * transaction.gross
+        
+        if transaction.status != TransactionStatus.COMPLETED:
+            return
+        
+        if transaction.type == TransactionType.STRIPE_DEPOSIT:
+            self._aggregates[transaction.user_id]['deposits'] += sign * transaction.net
+        elif transaction.type == TransactionType.CARD_TO_CARD:
+            self._aggregates[transaction.user_id]['transfers_out'] += sign * transaction.gross
+    
+    @staticmethod
+    def _new_dedup_filter():
+        """Фильтр Блума постоянного размера; без pybloom-live - обычное множество"""
+        if BLOOM_AVAILABLE:
+            return BloomFilter(capacity=_DEDUP_CAPACITY, error_rate=_DEDUP_ERROR_RATE)
+        return set()
+    
+    def _remember_dedup_key(self, key: str):
+        """Добавление ключа в активный фильтр с ротацией при заполнении"""
+        if len(self._dedup[0]) >= _DEDUP_CAPACITY:
+            self._dedup = [self._new_dedup_filter(), self._dedup[0]]
+        self._dedup[0].add(key)
+    
+    def _find_duplicate(self, user_id: str, key: str) -> Optional[Transaction]:
+        """
+        Поиск ранее записанной транзакции пользователя с тем же ключом.
+        Транзакции просматриваются только при срабатывании фильтра (в том числе
+        ложном). Неудачные (FAILED) не считаются дублями: запрос можно повторить.
+        """
+        if key not in self._dedup[0] and key not in self._dedup[1]:
+            return None
+        
+        for transaction in reversed(self._by_user.get(user_id, ())):
+            if (transaction.metadata and transaction.metadata.get('dedup_key') == key
+                    and transaction.status != _TS_FAILED):
+                return transaction
+        return None
+    
+    @staticmethod
+    def _transaction_from_dict(item: Dict, timestamps: Optional[Dict[str, datetime]] = None) -> Transaction:
+        """
+        Восстановление транзакции из словаря.
+        Суммы хранятся в центах (int); записи старого формата хранили доллары (float).
+        timestamps - кеш уже разобранных меток времени на время загрузки.
+        """
+        raw_timestamp = item['timestamp']
+        timestamp = timestamps.get(raw_timestamp) if timestamps is not None else None
+        if timestamp is None:
+            timestamp = datetime.fromisoformat(raw_timestamp)
+            if timestamps is not None:
+                timestamps[raw_timestamp] = timestamp
+        
+        return Transaction(
+            id=item['id'],
+            user_id=sys.intern(item['user_id']),
+            type=_TYPE_MAP[item['type']],
+            gross=Ledger._stored_cents(item['gross']),
+            net=Ledger._stored_cents(item['net']),
+            fee=Ledger._stored_cents(item['fee']),
+            status=_STATUS_MAP[item['status']],
+            timestamp=timestamp,
+            metadata=item.get('metadata')
+        )
+    
+    @staticmethod
+    def _stored_cents(value) -> int:
+        """Сумма из журнала в центах с учетом старого формата в долларах"""
+        return value if isinstance(value, int) else to_cents(value)
+    
+    def _append(self, record):
+        """
+        Дозапись одной строки в журнал.
+        record - словарь или Transaction: orjson сериализует dataclass, Enum
+        и datetime напрямую, без промежуточного to_dict().
+        """
+        line = orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        if self._batch_depth:
+            self._pending.append(line)
+            return
+        self._write(line)
+    
+    def _write(self, data: bytes):
+        """Запись готовых строк в конец журнала"""
         try:
-            data = [tx.to_dict() for tx in self.transactions]
-            with open(self.storage_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            if self._file is None:
+                self._file = open(self.storage_file, 'ab')
+            self._file.write(data)
+            self._file.flush()
         except Exception as e:
             print(f"Ошибка сохранения транзакций: {e}")
     
+    @contextmanager
+    def batch(self):
+        """
+        Объединение изменений в одну запись на диск.
+        Внутри блока строки журнала копятся в памяти и записываются при выходе
+        из внешнего блока (вложенные batch() допускаются). Блок выполняется под
+        блокировкой Ledger, поэтому проверка и запись внутри него атомарны.
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._pending:
+                    data = b''.join(self._pending)
+                    self._pending.clear()
+                    self._write(data)
+    
+    @_locked
+    def compact(self):
+        """Перезапись журнала снимком текущего состояния без дельт"""
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            
+            tmp_file = self.storage_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                for tx in self.transactions:
+                    f.write(orjson.dumps(tx, option=orjson.OPT_APPEND_NEWLINE))
+            os.replace(tmp_file, self.storage_file)
+            self._delta_count = 0
+            # Снимок уже содержит отложенные изменения
+            self._pending.clear()
+        except Exception as e:
+            print(f"Ошибка сжатия журнала транзакций: {e}")
+    
+    def dump_pretty(self, output_file: str):
+        """
+        Выгрузка всех транзакций в читаемый JSON с отступами (для просмотра человеком,
+        суммы в долларах). Сам журнал пишется компактно, по одной строке на запись.
+        Сериализация идет под блокировкой, запись в файл - уже без нее.
+        """
+        with self._lock:
+            data = orjson.dumps([tx.to_public_dict() for tx in self.transactions], option=orjson.OPT_INDENT_2)
+        with open(output_file, 'wb') as f:
+            f.write(data)
+    
+    @_locked
     def log_transaction(self, user_id: str, transaction_type: TransactionType, 
-                       gross: float, net: float, fee: float, 
-                       status: TransactionStatus, metadata: Optional[Dict] = None) -> str:
-        """Логирование новой транзакции"""
+                       gross: int, net: int, fee: int, 
+                       status: TransactionStatus, metadata: Optional[Dict] = None,
+                       dedup_key: Optional[str] = None) -> str:
+        """
+        Логирование новой транзакции (суммы в центах).
+        Если передан dedup_key (ключ идемпотентности запроса) и транзакция
+        пользователя с таким ключом уже записана, новая не создается
+        и возвращается id существующей.
+        """
+        if dedup_key:
+            duplicate = self._find_duplicate(user_id, dedup_key)
+            if duplicate is not None:
+                return duplicate.id
+            metadata = dict(metadata or {}, dedup_key=dedup_key)
+        
         transaction_id = str(uuid.uuid4())
         transaction = Transaction(
             id=transaction_id,
-            user_id=user_id,
+            # Одна строка user_id на пользователя вместо копии в каждой транзакции
+            user_id=sys.intern(user_id),
             type=transaction_type,
             gross=gross,
             net=net,
@@ -138,21 +452,91 @@ class Ledger:
             metadata=metadata
         )
         
-        self.transactions.append(transaction)
-        self._save_transactions()
+        self._add(transaction)
+        self._append(transaction)
         return transaction_id
     
-    def get_transactions(self, user_id: str) -> List[Transaction]:
-        """Получение всех транзакций пользователя"""
-        return [tx for tx in self.transactions if tx.user_id == user_id]
+    @_locked
+    def find_by_dedup_key(self, user_id: str, dedup_key: str) -> Optional[Transaction]:
+        """Ранее записанная (не FAILED) транзакция пользователя с ключом dedup_key"""
+        return self._find_duplicate(user_id, dedup_key)
+    
+    @_locked
+    def get_transactions(self, user_id: str, since: Optional[datetime] = None,
+                         until: Optional[datetime] = None) -> List[Transaction]:
+        """
+        Получение транзакций пользователя в порядке времени.
+        since/until ограничивают интервал включительно (поиск границ за O(log N)).
+        """
+        if since is not None or until is not None:
+            timestamps = self._by_user_ts.get(user_id, ())
+            lo = bisect.bisect_left(timestamps, since) if since is not None else 0
+            hi = bisect.bisect_right(timestamps, until) if until is not None else len(timestamps)
+            return self._by_user[user_id][lo:hi] if lo < hi else []
+        
+        return list(self._by_user.get(user_id, ()))
+    
+    @_locked
+    def get_transactions_page(self, user_id: str, limit: int,
+                              before: Optional[str] = None) -> Tuple[List[Transaction], Optional[str]]:
+        """
+        Страница транзакций пользователя от новых к старым (keyset-пагинация).
+        
+        Args:
+            user_id: ID пользователя
+            limit: Размер страницы
+            before: id транзакции-курсора; страница начинается с более старых
+        
+        Returns:
+            (транзакции страницы, курсор следующей страницы или None)
+        
+        Raises:
+            ValueError: Если курсор не является транзакцией этого пользователя
+        """
+        user_transactions = self._by_user.get(user_id, [])
+        
+        if before is None:
+            end = len(user_transactions)
+        else:
+            cursor = self._by_id.get(before)
+            if cursor is None or cursor.user_id != user_id:
+                raise ValueError(f"Неизвестный курсор: {before}")
+            # Позиция курсора: бинарный поиск по времени, затем среди равных меток
+            end = bisect.bisect_left(self._by_user_ts[user_id], cursor.timestamp)
+            while user_transactions[end] is not cursor:
+                end += 1
+        
+        start = max(0, end - limit)
+        page = user_transactions[start:end][::-1]
+        next_cursor = page[-1].id if start > 0 else None
+        return page, next_cursor
+    
+    @_locked
+    def get_status_totals(self, user_id: str) -> Dict[str, Tuple[int, int]]:
+        """Число транзакций пользователя и сумма gross (в центах) по каждому статусу"""
+        totals = self._status_totals.get(user_id, {})
+        return {status: (count, gross) for status, (count, gross) in totals.items()}
+    
+    @_locked
+    def get_aggregates(self, user_id: str) -> Dict:
+        """Агрегаты пользователя: сумма пополнений и переводов (в центах), число транзакций"""
+        aggregates = self._aggregates.get(user_id)
+        if aggregates is None:
+            return {'deposits': 0, 'transfers_out': 0, 'count': 0}
+        return dict(aggregates)
     
+    @_locked
     def update_transaction_status(self, transaction_id: str, status: TransactionStatus):
         """Обновление статуса транзакции"""
-        for tx in self.transactions:
-            if tx.id == transaction_id:
-                tx.status = status
-                self._save_transactions()
-                break
+        tx = self._by_id.get(transaction_id)
+        if tx is None:
+            return
+        
+        self._set_status(tx, status)
+        self._append({'op': 'status', 'id': transaction_id, 'status': status.value})
+        self._delta_count += 1
+        if self._delta_count > self.compact_threshold:
+            self.compact()
 
 
 class StripePayments:
@@ -161,21 +545,35 @@ class StripePayments:
     def __init__(self, secret_key: str):
         self.secret_key = secret_key
         self.initialized = STRIPE_INITIALIZED and STRIPE_AVAILABLE
-    
-    def create_payment_intent(self, amount: float, currency: str = 'usd', 
-                            metadata: Optional[Dict] = None) -> Dict:
-        """Создание PaymentIntent для ввода средств"""
-        if not self.initialized:
-            return {
-                'success': False,
-                'error': 'Stripe API не инициализирован'
-            }
         
+        # Без инициализации методы API подменяются заглушкой один раз,
+        # вместо проверки self.initialized в каждом вызове
+        if not self.initialized:
+            self.create_payment_intent = self._uninitialized
+            self.create_checkout_session = self._uninitialized
+            self.retrieve_payment_intent = self._uninitialized
+            self.create_transfer = self._uninitialized
+            self.create_charge = self._uninitialized
+    
+    @staticmethod
+    def _uninitialized(*args, **kwargs) -> Dict:
+        """Заглушка методов API при неинициализированном Stripe"""
+        # Копия: вызывающий код дополняет ответ (например, transaction_id)
+        return dict(_STRIPE_UNINIT_RESULT)
+    
+    def create_payment_intent(self, amount: int, currency: str = 'usd', 
+                            metadata: Optional[Dict] = None,
+                            idempotency_key: Optional[str] = None) -> Dict:
+        """
+        Создание PaymentIntent для ввода средств (сумма в центах).
+        Повторный запрос с тем же idempotency_key не создаст второй платеж.
+        """
         try:
             intent = stripe.PaymentIntent.create(
-                amount=int(amount * 100),  # Stripe работает с центами
+                amount=amount,  # Stripe работает с центами
                 currency=currency,
-                metadata=metadata or {}
+                metadata=metadata or {},
+                idempotency_key=idempotency_key
             )
             return {
                 'success': True,
@@ -190,15 +588,10 @@ class StripePayments:
                 'error': str(e)
             }
     
-    def create_checkout_session(self, amount: float, user_id: str, 
-                              success_url: str, cancel_url: str) -> Dict:
-        """Создание Checkout Session для ввода средств"""
-        if not self.initialized:
-            return {
-                'success': False,
-                'error': 'Stripe API не инициализирован'
-            }
-        
+    def create_checkout_session(self, amount: int, user_id: str, 
+                              success_url: str, cancel_url: str,
+                              idempotency_key: Optional[str] = None) -> Dict:
+        """Создание Checkout Session для ввода средств (сумма в центах)"""
         try:
             session = stripe.checkout.Session.create(
                 payment_method_types=['card'],
@@ -208,14 +601,15 @@ class StripePayments:
                         'product_data': {
                             'name': 'Пополнение баланса',
                         },
-                        'unit_amount': int(amount * 100),  # В центах
+                        'unit_amount': amount,  # В центах
                     },
                     'quantity': 1,
                 }],
                 mode='payment',
                 success_url=success_url,
                 cancel_url=cancel_url,
-                metadata={'user_id': user_id}
+                metadata={'user_id': user_id},
+                idempotency_key=idempotency_key
             )
             return {
                 'success': True,
@@ -230,12 +624,6 @@ class StripePayments:
     
     def retrieve_payment_intent(self, payment_intent_id: str) -> Dict:
         """Получение информации о PaymentIntent"""
-        if not self.initialized:
-            return {
-                'success': False,
-                'error': 'Stripe API не инициализирован'
-            }
-        
         try:
             intent = stripe.PaymentIntent.retrieve(payment_intent_id)
             return {
@@ -250,22 +638,18 @@ class StripePayments:
                 'error': str(e)
             }
     
-    def create_transfer(self, amount: float, destination_account: str, 
-                       source_transaction: str = None, metadata: Optional[Dict] = None) -> Dict:
-        """Создание перевода через Stripe Connect"""
-        if not self.initialized:
-            return {
-                'success': False,
-                'error': 'Stripe API не инициализирован'
-            }
-        
+    def create_transfer(self, amount: int, destination_account: str, 
+                       source_transaction: str = None, metadata: Optional[Dict] = None,
+                       idempotency_key: Optional[str] = None) -> Dict:
+        """Создание перевода через Stripe Connect (сумма в центах)"""
         try:
             transfer = stripe.Transfer.create(
-                amount=int(amount * 100),  # В центах
+                amount=amount,  # В центах
                 currency='usd',
                 destination=destination_account,
                 source_transaction=source_transaction,
-                metadata=metadata or {}
+                metadata=metadata or {},
+                idempotency_key=idempotency_key
             )
             return {
                 'success': True,
@@ -279,22 +663,18 @@ class StripePayments:
                 'error': str(e)
             }
     
-    def create_charge(self, amount: float, source: str, 
-                     description: str = None, metadata: Optional[Dict] = None) -> Dict:
-        """Создание списания с карты"""
-        if not self.initialized:
-            return {
-                'success': False,
-                'error': 'Stripe API не инициализирован'
-            }
-        
+    def create_charge(self, amount: int, source: str, 
+                     description: str = None, metadata: Optional[Dict] = None,
+                     idempotency_key: Optional[str] = None) -> Dict:
+        """Создание списания с карты (сумма в центах)"""
         try:
             charge = stripe.Charge.create(
-                amount=int(amount * 100),  # В центах
+                amount=amount,  # В центах
                 currency='usd',
                 source=source,
                 description=description,
-                metadata=metadata or {}
+                metadata=metadata or {},
+                idempotency_key=idempotency_key
             )
             return {
                 'success': True,
@@ -314,80 +694,255 @@ ledger = Ledger()
 stripe_payments = StripePayments(STRIPE_SECRET_KEY) if STRIPE_SECRET_KEY and STRIPE_AVAILABLE else None
 
 
+_STRIPE_NOT_CONFIGURED_ERROR = 'Stripe API не настроен. Установите STRIPE_SECRET_KEY в переменных окружения.'
+
+# Максимум одновременных запросов к Stripe в deposit_via_stripe_batch.
+# У пакетов свой пул потоков, чтобы они не занимали пул по умолчанию,
+# которым пользуются обработчики API (asyncio.to_thread)
+STRIPE_BATCH_CONCURRENCY = 8
+_stripe_batch_executor = ThreadPoolExecutor(
+    max_workers=STRIPE_BATCH_CONCURRENCY, thread_name_prefix="stripe-batch"
+)
+
+
+def _scoped_idempotency_key(operation: str, user_id: str, idempotency_key: Optional[str]) -> Optional[str]:
+    """
+    Ключ идемпотентности клиента с привязкой к операции и пользователю
+    (ключи Stripe общие для всего аккаунта, а клиенты выбирают их сами)
+    """
+    if not idempotency_key:
+        return None
+    return f"{operation}:{user_id}:{idempotency_key}"
+
+
+def _is_conflict(gross_cents: int, duplicate: Optional[Transaction]) -> bool:
+    """Повтор ключа идемпотентности с другой суммой (Stripe в этом случае тоже отказывает)"""
+    return duplicate is not None and duplicate.gross != gross_cents
+
+
+def _conflict_result(duplicate: Transaction) -> Dict:
+    """Отказ на повтор ключа идемпотентности с другой суммой"""
+    return {
+        'success': False,
+        'conflict': True,
+        'error': 'Ключ идемпотентности уже использован для запроса с другой суммой',
+        'transaction_id': duplicate.id
+    }
+
+
+def _finish_replay(result: Dict, duplicate: Transaction) -> Dict:
+    """
+    Ответ на повтор запроса: объект Stripe, который вернулся по тому же ключу,
+    и id и сумма (в долларах) ранее записанной транзакции. Ledger не изменяется.
+    """
+    result['transaction_id'] = duplicate.id
+    result['amount'] = from_cents(duplicate.gross)
+    result['duplicate'] = True
+    return result
+
+
+def _log_pending_deposit(user_id: str, amount: float,
+                         dedup_key: Optional[str] = None) -> Tuple[str, int, Optional[Transaction]]:
+    """
+    Запись ввода средств в Ledger как pending; все суммы в целых центах.
+    Если у пользователя уже есть транзакция с ключом dedup_key (повтор запроса),
+    новая не записывается.
+    
+    Returns:
+        (transaction_id, gross_cents, найденный дубль или None);
+        для дубля transaction_id - его id, gross_cents - сумма нового запроса
+    """
+    gross_cents = to_cents(amount)
+    fee_cents = (gross_cents * _STRIPE_RATE_PERMILLE + 500) // 1000 + _STRIPE_FLAT_CENTS
+    net_cents = gross_cents - fee_cents
+    
+    # Проверка и запись под одной блокировкой: параллельный повтор не пройдет между ними
+    with ledger.batch():
+        duplicate = ledger.find_by_dedup_key(user_id, dedup_key) if dedup_key else None
+        if duplicate is not None:
+            return duplicate.id, gross_cents, duplicate
+        
+        transaction_id = ledger.log_transaction(
+            user_id=user_id,
+            transaction_type=_TT_DEPOSIT,
+            gross=gross_cents,
+            net=net_cents,
+            fee=fee_cents,
+            status=_TS_PENDING,
+            dedup_key=dedup_key
+        )
+    return transaction_id, gross_cents, None
+
+
+def _create_stripe_deposit(user_id: str, gross_cents: int, transaction_id: str,
+                           success_url: str = None, cancel_url: str = None,
+                           idempotency_key: Optional[str] = None) -> Dict:
+    """
+    Создание Checkout Session или PaymentIntent для ввода средств (без записи в Ledger).
+    Без ключа идемпотентности клиента ключом для Stripe служит transaction_id.
+    """
+    idempotency_key = idempotency_key or transaction_id
+    if success_url and cancel_url:
+        return stripe_payments.create_checkout_session(
+            amount=gross_cents,
+            user_id=user_id,
+            success_url=success_url,
+            cancel_url=cancel_url,
+            idempotency_key=idempotency_key
+        )
+    return stripe_payments.create_payment_intent(
+        amount=gross_cents,
+        metadata={'user_id': user_id, 'transaction_id': transaction_id},
+        idempotency_key=idempotency_key
+    )
+
+
+def _finish_deposit(result: Dict, transaction_id: str) -> Dict:
+    """Отметка неудачного ввода средств в Ledger и добавление transaction_id в ответ"""
+    if not result['success']:
+        ledger.update_transaction_status(transaction_id, _TS_FAILED)
+    result['transaction_id'] = transaction_id
+    return result
+
+
 def deposit_via_stripe(user_id: str, amount: float, 
-                      success_url: str = None, cancel_url: str = None) -> Dict:
-    """Ввод средств через Stripe"""
+                      success_url: str = None, cancel_url: str = None,
+                      idempotency_key: Optional[str] = None) -> Dict:
+    """
+    Ввод средств через Stripe.
+    idempotency_key - ключ клиента (заголовок Idempotency-Key): повтор запроса
+    с тем же ключом не записывает новую транзакцию, а Stripe по тому же ключу
+    возвращает исходный объект (client_secret или url) - второго платежа нет.
+    Повтор с другой суммой отклоняется (conflict в ответе).
+    """
     if not stripe_payments:
         return {
             'success': False,
-            'error': 'Stripe API не настроен. Установите STRIPE_SECRET_KEY в переменных окружения.'
+            'error': _STRIPE_NOT_CONFIGURED_ERROR
         }
     
-    # Логируем транзакцию как pending
-    fee = amount * 0.029 + 0.30  # Stripe комиссия: 2.9% + $0.30
-    net_amount = amount - fee
-    
-    transaction_id = ledger.log_transaction(
-        user_id=user_id,
-        transaction_type=TransactionType.STRIPE_DEPOSIT,
-        gross=amount,
-        net=net_amount,
-        fee=fee,
-        status=TransactionStatus.PENDING,
-        metadata={'amount': amount}
-    )
+    key = _scoped_idempotency_key('deposit', user_id, idempotency_key)
+    transaction_id, gross_cents, duplicate = _log_pending_deposit(user_id, amount, key)
+    if _is_conflict(gross_cents, duplicate):
+        return _conflict_result(duplicate)
     
-    # Создаём Checkout Session или PaymentIntent
-    if success_url and cancel_url:
-        result = stripe_payments.create_checkout_session(
-            amount=amount,
-            user_id=user_id,
-            success_url=success_url,
-            cancel_url=cancel_url
-        )
-    else:
-        result = stripe_payments.create_payment_intent(
-            amount=amount,
-            metadata={'user_id': user_id, 'transaction_id': transaction_id}
-        )
+    result = _create_stripe_deposit(user_id, gross_cents, transaction_id, success_url, cancel_url, key)
+    if duplicate is not None:
+        return _finish_replay(result, duplicate)
+    return _finish_deposit(result, transaction_id)
+
+
+def _log_pending_deposits(items: List[Dict], keys: List[Optional[str]]) -> List[Tuple[str, int, Optional[Transaction]]]:
+    """Запись pending-транзакций пакета одной записью на диск (см. _log_pending_deposit)"""
+    with ledger.batch():
+        return [
+            _log_pending_deposit(item['user_id'], item['amount'], key)
+            for item, key in zip(items, keys)
+        ]
+
+
+def _finish_deposits(pending: List[Tuple[str, int, Optional[Transaction]]], created: List[Dict]) -> List[Dict]:
+    """Результаты пакета в порядке pending; записи failed попадают на диск одной записью"""
+    results = []
+    created = iter(created)
+    with ledger.batch():
+        for transaction_id, gross_cents, duplicate in pending:
+            if _is_conflict(gross_cents, duplicate):
+                results.append(_conflict_result(duplicate))
+            elif duplicate is not None:
+                results.append(_finish_replay(next(created), duplicate))
+            else:
+                results.append(_finish_deposit(next(created), transaction_id))
+    return results
+
+
+async def deposit_via_stripe_batch(items: List[Dict]) -> List[Dict]:
+    """
+    Пакетный ввод средств через Stripe.
     
-    if result['success']:
-        result['transaction_id'] = transaction_id
-    else:
-        ledger.update_transaction_status(transaction_id, TransactionStatus.FAILED)
-        result['transaction_id'] = transaction_id
+    Запросы к Stripe выполняются параллельно в отдельном пуле потоков (не более
+    STRIPE_BATCH_CONCURRENCY одновременно), поэтому время пакета определяется
+    самым долгим запросом, а не их суммой. Записи pending и failed попадают
+    на диск одной записью каждая; Ledger изменяется в пуле потоков по умолчанию,
+    чтобы ожидание его блокировки (например, во время compact) не останавливало
+    цикл событий.
     
-    return result
+    Args:
+        items: Список словарей с ключами user_id, amount и
+            необязательными success_url, cancel_url, idempotency_key
+    
+    Returns:
+        List[Dict]: Результаты в порядке items, как у deposit_via_stripe
+    """
+    if not stripe_payments:
+        return [{'success': False, 'error': _STRIPE_NOT_CONFIGURED_ERROR} for _ in items]
+    
+    keys = [_scoped_idempotency_key('deposit', item['user_id'], item.get('idempotency_key')) for item in items]
+    pending = await asyncio.to_thread(_log_pending_deposits, items, keys)
+    
+    # Повторы с другой суммой в Stripe не отправляются
+    loop = asyncio.get_running_loop()
+    created = await asyncio.gather(*(
+        loop.run_in_executor(
+            _stripe_batch_executor, _create_stripe_deposit, item['user_id'], gross_cents,
+            transaction_id, item.get('success_url'), item.get('cancel_url'), key
+        )
+        for item, key, (transaction_id, gross_cents, duplicate) in zip(items, keys, pending)
+        if not _is_conflict(gross_cents, duplicate)
+    ))
+    
+    return await asyncio.to_thread(_finish_deposits, pending, created)
 
 
-def create_card_to_card_transaction(user_id: str, amount: float, from_payment_method: str, to_payment_method: str):
+def create_card_to_card_transaction(user_id: str, amount: float, from_payment_method: str, to_payment_method: str,
+                                    status: TransactionStatus = TransactionStatus.COMPLETED,
+                                    idempotency_key: Optional[str] = None):
     """
     Перевод между картами (эмуляция через Stripe PaymentIntent).
     В реальном проекте нужен Stripe Connect.
+    
+    status - статус, с которым записывается успешный перевод; задается сразу,
+    чтобы не делать отдельную запись update_transaction_status.
+    idempotency_key - ключ клиента (заголовок Idempotency-Key): повтор запроса
+    с тем же ключом не записывает новую транзакцию, а Stripe по тому же ключу
+    возвращает исходный PaymentIntent. Повтор с другой суммой отклоняется.
     """
-    transaction_id = str(uuid.uuid4())
+    key = _scoped_idempotency_key('card_to_card', user_id, idempotency_key)
+    amount_cents = to_cents(amount)
+    duplicate = ledger.find_by_dedup_key(user_id, key) if key else None
+    if _is_conflict(amount_cents, duplicate):
+        return _conflict_result(duplicate)
+    
     try:
         if not STRIPE_AVAILABLE or not STRIPE_SECRET_KEY:
             raise ValueError("Stripe не настроен")
 
         # Создаём PaymentIntent на списание
         payment_intent = stripe.PaymentIntent.create(
-            amount=int(amount * 100),  # в центах
+            amount=amount_cents,  # в центах
             currency="usd",
-            automatic_payment_methods={'enabled': True}
+            automatic_payment_methods={'enabled': True},
+            idempotency_key=key or str(uuid.uuid4())
         )
 
-        # Для теста считаем перевод успешным
-        ledger.log_transaction(user_id, TransactionType.CARD_TO_CARD, amount, amount, 0.0, TransactionStatus.COMPLETED)
-
-        return {
+        result = {
             "success": True,
-            "transaction_id": transaction_id,
             "payment_intent_id": payment_intent.id
         }
+        if duplicate is not None:
+            return _finish_replay(result, duplicate)
+
+        # Для теста считаем перевод успешным; при параллельном повторе с тем же
+        # ключом Ledger вернет id уже записанной транзакции
+        result["transaction_id"] = ledger.log_transaction(user_id, TransactionType.CARD_TO_CARD, amount_cents,
+                                                          amount_cents, 0, status, dedup_key=key)
+        return result
 
     except Exception as e:
-        ledger.log_transaction(user_id, TransactionType.CARD_TO_CARD, amount, amount, 0.0, TransactionStatus.FAILED)
+        if duplicate is not None:
+            return _finish_replay({"success": False, "error": str(e)}, duplicate)
+        transaction_id = ledger.log_transaction(user_id, TransactionType.CARD_TO_CARD, amount_cents, amount_cents, 0,
+                                                TransactionStatus.FAILED)
         return {"success": False, "error": str(e), "transaction_id": transaction_id}
 
 
@@ -424,32 +979,49 @@ def confirm_stripe_payment(payment_intent_id: str) -> Dict:
     }
 
 
-def get_user_transactions(user_id: str) -> List[Dict]:
-    """Получение всех транзакций пользователя"""
-    transactions = ledger.get_transactions(user_id)
-    return [tx.to_dict() for tx in transactions]
+def get_user_transactions(user_id: str, since: Optional[datetime] = None,
+                          until: Optional[datetime] = None) -> List[Dict]:
+    """Получение транзакций пользователя, при необходимости за интервал времени (суммы в долларах)"""
+    transactions = ledger.get_transactions(user_id, since, until)
+    return [tx.to_public_dict() for tx in transactions]
 
 
-def get_user_balance(user_id: str) -> Dict:
-    """Получение баланса пользователя на основе транзакций"""
-    transactions = ledger.get_transactions(user_id)
-    
-    total_deposits = sum(tx.net for tx in transactions 
-                        if tx.type == TransactionType.STRIPE_DEPOSIT 
-                        and tx.status == TransactionStatus.COMPLETED)
-    
-    total_transfers_out = sum(tx.gross for tx in transactions 
-                             if tx.type == TransactionType.CARD_TO_CARD 
-                             and tx.status == TransactionStatus.COMPLETED)
+def get_user_transactions_page(user_id: str, limit: int, cursor: Optional[str] = None) -> Dict:
+    """
+    Страница транзакций пользователя от новых к старым (суммы в долларах)
     
-    balance = total_deposits - total_transfers_out
+    Raises:
+        ValueError: Если cursor не является транзакцией этого пользователя
+    """
+    transactions, next_cursor = ledger.get_transactions_page(user_id, limit, cursor)
+    return {
+        'transactions': [tx.to_public_dict() for tx in transactions],
+        'next_cursor': next_cursor,
+        'total_count': ledger.get_aggregates(user_id)['count']
+    }
+
+
+def get_user_transaction_stats(user_id: str) -> Dict[str, Tuple[int, float]]:
+    """
+    Статистика транзакций пользователя по статусам из агрегатов Ledger,
+    без выборки истории: {status: (число транзакций, сумма gross в долларах)}
+    """
+    return {
+        status: (count, from_cents(gross))
+        for status, (count, gross) in ledger.get_status_totals(user_id).items()
+    }
+
+
+def get_user_balance(user_id: str) -> Dict:
+    """Получение баланса пользователя по агрегатам Ledger (суммы в долларах)"""
+    aggregates = ledger.get_aggregates(user_id)
     
     return {
         'user_id': user_id,
-        'balance': balance,
-        'total_deposits': total_deposits,
-        'total_transfers': total_transfers_out,
-        'transaction_count': len(transactions)
+        'balance': from_cents(aggregates['deposits'] - aggregates['transfers_out']),
+        'total_deposits': from_cents(aggregates['deposits']),
+        'total_transfers': from_cents(aggregates['transfers_out']),
+        'transaction_count': aggregates['count']
     }
 
 
@@ -3,32 +3,78 @@ FastAPI роутер для платежных операций.
 Включает эндпоинты для переводов, пополнений и управления балансом.
 """
 
-from fastapi import APIRouter, HTTPException, status
-from pydantic import BaseModel
+import asyncio
+import os
+from datetime import datetime, timezone
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional
 import logging
+import cache
 from payments.payments import (
     create_card_to_card_transaction,
     deposit_via_stripe,
-    get_user_transactions,
+    get_user_transactions_page,
+    get_user_transaction_stats,
     get_user_balance,
-    confirm_stripe_payment
+    confirm_stripe_payment,
+    STRIPE_AVAILABLE,
+    STRIPE_INITIALIZED
 )
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Размер страницы транзакций по умолчанию и максимальный
+TRANSACTIONS_PAGE_SIZE = 50
+TRANSACTIONS_MAX_PAGE_SIZE = 200
+
+# Максимальная длина ключа из заголовка Idempotency-Key
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+# Ответ проверки состояния: все, кроме времени, известно при запуске
+_HEALTH_TEMPLATE = {
+    "status": "healthy",
+    "timestamp": None,
+    "services": {
+        "stripe_api": {
+            "available": STRIPE_AVAILABLE,
+            "initialized": STRIPE_INITIALIZED,
+            "secret_key_configured": bool(os.getenv('STRIPE_SECRET_KEY'))
+        },
+        "ledger": {
+            "available": True,
+            "status": "operational"
+        }
+    },
+    "message": "Платежная система работает нормально"
+}
+
 # Создаем роутер для платежей
 payments_router = APIRouter(
     prefix="/payments",
     tags=["payments"],
+    default_response_class=ORJSONResponse,
     responses={404: {"description": "Not found"}}
 )
 
+async def _invalidate_payment_cache(user_id: int):
+    """Сброс кешированных баланса, статистики и транзакций пользователя после записи"""
+    await cache.invalidate(*cache.payment_keys(user_id))
+
+class PaymentError(HTTPException):
+    """Ожидаемая ошибка платежной операции (ответ 400 с описанием)"""
+    
+    def __init__(self, detail: str, status_code: int = status.HTTP_400_BAD_REQUEST):
+        super().__init__(status_code=status_code, detail=detail)
+
 # Pydantic модели для платежей
 class CardToCardRequest(BaseModel):
     """Модель для запроса перевода с карты на карту"""
-    amount: float
+    model_config = ConfigDict(extra='forbid', frozen=True)
+    
+    amount: float = Field(gt=0)
     from_card_id: str
     to_card_id: str
     from_card_number: Optional[str] = None
@@ -36,135 +82,176 @@ class CardToCardRequest(BaseModel):
 
 class DepositRequest(BaseModel):
     """Модель для запроса пополнения баланса"""
-    amount: float
+    model_config = ConfigDict(extra='forbid', frozen=True)
+    
+    amount: float = Field(gt=0)
     success_url: Optional[str] = None
     cancel_url: Optional[str] = None
 
 class PaymentConfirmRequest(BaseModel):
     """Модель для подтверждения платежа"""
+    model_config = ConfigDict(extra='forbid', frozen=True)
+    
     payment_intent_id: str
 
 class PaymentResponse(BaseModel):
-    """Базовая модель ответа для платежей"""
+    """Базовая модель ответа для платежей (дополнительные поля ответа Stripe сохраняются)"""
+    model_config = ConfigDict(extra='allow')
+    
     success: bool
     message: Optional[str] = None
     transaction_id: Optional[str] = None
     error: Optional[str] = None
 
 # Эндпоинты для переводов с карты на карту
-@payments_router.post("/card-to-card/{user_id}", response_model=dict)
-async def create_card_to_card_payment(user_id: int, request: CardToCardRequest):
+@payments_router.post("/card-to-card/{user_id}", response_model=None, responses={200: {"model": PaymentResponse}})
+async def create_card_to_card_payment(
+    user_id: int,
+    request: CardToCardRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=IDEMPOTENCY_KEY_MAX_LENGTH)
+):
     """
     Перевод с карты на карту
     
     Args:
         user_id: ID пользователя
         request: Данные перевода (сумма, карты)
+        idempotency_key: Ключ из заголовка Idempotency-Key; повтор запроса
+            с тем же ключом не создает второй платеж
         
     Returns:
         Результат перевода с transaction_id и payment_intent_id
-    """
-    try:
-        logger.info(f"Запрос перевода с карты на карту для пользователя {user_id}")
-        
-        result = create_card_to_card_transaction(
-            user_id=str(user_id),
-            amount=request.amount,
-            from_payment_method=request.from_card_id,
-            to_payment_method=request.to_card_id
-        )
         
-        # Добавляем дополнительную информацию в ответ
-        if result["success"]:
-            result["message"] = f"Перевод на сумму ${request.amount} успешно создан"
-            result["from_card_id"] = request.from_card_id
-            result["to_card_id"] = request.to_card_id
-            result["amount"] = request.amount
-        
-        logger.info(f"Результат перевода для пользователя {user_id}: {result}")
-        return result
-        
-    except Exception as e:
-        logger.error(f"Ошибка перевода для пользователя {user_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка перевода: {str(e)}"
-        )
+    Raises:
+        PaymentError: 409, если ключ Idempotency-Key уже использован с другой суммой
+    """
+    logger.info("Запрос перевода с карты на карту для пользователя %s", user_id)
+    amount = request.amount
+    from_card_id = request.from_card_id
+    to_card_id = request.to_card_id
+    
+    # Stripe SDK синхронный: вызов в потоке, чтобы не блокировать цикл событий
+    result = await asyncio.to_thread(
+        create_card_to_card_transaction,
+        user_id=str(user_id),
+        amount=amount,
+        from_payment_method=from_card_id,
+        to_payment_method=to_card_id,
+        idempotency_key=idempotency_key
+    )
+    
+    if result.get("conflict"):
+        raise PaymentError(result["error"], status.HTTP_409_CONFLICT)
+    
+    # Добавляем дополнительную информацию в ответ; ответ на повтор запроса
+    # описывает ранее созданную транзакцию, поэтому данные текущего запроса не добавляются
+    if result["success"] and not result.get("duplicate"):
+        result["message"] = f"Перевод на сумму ${amount} успешно создан"
+        result["from_card_id"] = from_card_id
+        result["to_card_id"] = to_card_id
+        result["amount"] = amount
+    
+    await _invalidate_payment_cache(user_id)
+    
+    logger.debug("Результат перевода для пользователя %s: %s", user_id, result)
+    return ORJSONResponse(result)
 
 # Эндпоинты для пополнения баланса
-@payments_router.post("/deposit/{user_id}", response_model=dict)
-async def create_deposit(user_id: int, request: DepositRequest):
+@payments_router.post("/deposit/{user_id}", response_model=None, responses={200: {"model": PaymentResponse}})
+async def create_deposit(
+    user_id: int,
+    request: DepositRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=IDEMPOTENCY_KEY_MAX_LENGTH)
+):
     """
     Пополнение баланса через Stripe
     
     Args:
         user_id: ID пользователя
         request: Данные пополнения (сумма, URL для редиректа)
+        idempotency_key: Ключ из заголовка Idempotency-Key; повтор запроса
+            с тем же ключом не создает второй платеж
         
     Returns:
         Результат создания пополнения с session_id или client_secret
-    """
-    try:
-        logger.info(f"Запрос пополнения для пользователя {user_id}")
-        
-        result = deposit_via_stripe(
-            user_id=str(user_id),
-            amount=request.amount,
-            success_url=request.success_url,
-            cancel_url=request.cancel_url
-        )
-        
-        # Добавляем дополнительную информацию в ответ
-        if result["success"]:
-            result["message"] = f"Пополнение на сумму ${request.amount} успешно создано"
-            result["amount"] = request.amount
         
-        logger.info(f"Результат пополнения для пользователя {user_id}: {result}")
-        return result
-        
-    except Exception as e:
-        logger.error(f"Ошибка пополнения для пользователя {user_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка пополнения: {str(e)}"
-        )
+    Raises:
+        PaymentError: 409, если ключ Idempotency-Key уже использован с другой суммой
+    """
+    logger.info("Запрос пополнения для пользователя %s", user_id)
+    amount = request.amount
+    
+    result = await asyncio.to_thread(
+        deposit_via_stripe,
+        user_id=str(user_id),
+        amount=amount,
+        success_url=request.success_url,
+        cancel_url=request.cancel_url,
+        idempotency_key=idempotency_key
+    )
+    
+    if result.get("conflict"):
+        raise PaymentError(result["error"], status.HTTP_409_CONFLICT)
+    
+    # Добавляем дополнительную информацию в ответ; ответ на повтор запроса
+    # описывает ранее созданную транзакцию, поэтому данные текущего запроса не добавляются
+    if result["success"] and not result.get("duplicate"):
+        result["message"] = f"Пополнение на сумму ${amount} успешно создано"
+        result["amount"] = amount
+    
+    await _invalidate_payment_cache(user_id)
+    
+    logger.debug("Результат пополнения для пользователя %s: %s", user_id, result)
+    return ORJSONResponse(result)
 
 # Эндпоинты для получения информации о транзакциях
-@payments_router.get("/transactions/{user_id}", response_model=dict)
-async def get_user_payment_transactions(user_id: int):
+@payments_router.get("/transactions/{user_id}", response_model=None)
+async def get_user_payment_transactions(
+    user_id: int,
+    limit: int = Query(TRANSACTIONS_PAGE_SIZE, ge=1, le=TRANSACTIONS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
     """
-    Получение всех транзакций пользователя
+    Получение транзакций пользователя постранично, от новых к старым
     
     Args:
         user_id: ID пользователя
+        limit: Количество транзакций на странице
+        cursor: next_cursor из предыдущей страницы
         
     Returns:
-        Список транзакций пользователя с детальной информацией
-    """
-    try:
-        logger.info(f"Запрос транзакций для пользователя {user_id}")
+        Страница транзакций и next_cursor для следующей (None на последней)
         
-        transactions = get_user_transactions(str(user_id))
-        
-        result = {
+    Raises:
+        PaymentError: Если курсор не найден
+    """
+    logger.info("Запрос транзакций для пользователя %s", user_id)
+    
+    async def load():
+        # Чтение Ledger в потоке: его блокировку может удерживать compact в другом потоке
+        try:
+            page = await asyncio.to_thread(get_user_transactions_page, str(user_id), limit, cursor)
+        except ValueError as e:
+            raise PaymentError(str(e))
+        
+        logger.info("Получено %s транзакций для пользователя %s", len(page['transactions']), user_id)
+        return {
             "user_id": user_id,
-            "transactions": transactions,
-            "total_count": len(transactions),
-            "message": f"Найдено {len(transactions)} транзакций"
+            **page,
+            "message": f"Найдено {len(page['transactions'])} транзакций"
         }
-        
-        logger.info(f"Получено {len(transactions)} транзакций для пользователя {user_id}")
-        return result
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения транзакций для пользователя {user_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка получения транзакций: {str(e)}"
+    
+    # Кешируется только первая страница с размером по умолчанию
+    if cursor is None and limit == TRANSACTIONS_PAGE_SIZE:
+        payload = await cache.get_or_set(
+            cache.payment_transactions_key(user_id), cache.PAYMENT_TRANSACTIONS_TTL, load
         )
+        return Response(payload, media_type="application/json")
+    
+    return ORJSONResponse(await load())
 
 # Эндпоинты для получения баланса
-@payments_router.get("/balance/{user_id}", response_model=dict)
+@payments_router.get("/balance/{user_id}", response_model=None)
 async def get_user_payment_balance(user_id: int):
     """
     Получение баланса пользователя
@@ -175,26 +262,24 @@ async def get_user_payment_balance(user_id: int):
     Returns:
         Детальная информация о балансе пользователя
     """
-    try:
-        logger.info(f"Запрос баланса для пользователя {user_id}")
-        
-        balance = get_user_balance(str(user_id))
+    logger.info("Запрос баланса для пользователя %s", user_id)
+    
+    async def load():
+        balance = await asyncio.to_thread(get_user_balance, str(user_id))
         
         # Добавляем дополнительную информацию
         balance["message"] = f"Баланс пользователя {user_id} успешно получен"
         
-        logger.info(f"Баланс пользователя {user_id}: ${balance['balance']:.2f}")
+        logger.info("Баланс пользователя %s: $%.2f", user_id, balance['balance'])
         return balance
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения баланса для пользователя {user_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка получения баланса: {str(e)}"
-        )
+    
+    payload = await cache.get_or_set(
+        cache.payment_balance_key(user_id), cache.PAYMENT_BALANCE_TTL, load
+    )
+    return Response(payload, media_type="application/json")
 
 # Эндпоинты для подтверждения платежей
-@payments_router.post("/confirm", response_model=dict)
+@payments_router.post("/confirm", response_model=None, responses={200: {"model": PaymentResponse}})
 async def confirm_payment(request: PaymentConfirmRequest):
     """
     Подтверждение Stripe платежа
@@ -205,23 +290,21 @@ async def confirm_payment(request: PaymentConfirmRequest):
     Returns:
         Результат подтверждения платежа
     """
-    try:
-        logger.info(f"Запрос подтверждения платежа {request.payment_intent_id}")
-        
-        result = confirm_stripe_payment(request.payment_intent_id)
-        
-        logger.info(f"Результат подтверждения платежа {request.payment_intent_id}: {result}")
-        return result
-        
-    except Exception as e:
-        logger.error(f"Ошибка подтверждения платежа {request.payment_intent_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка подтверждения платежа: {str(e)}"
-        )
+    payment_intent_id = request.payment_intent_id
+    logger.info("Запрос подтверждения платежа %s", payment_intent_id)
+    
+    result = await asyncio.to_thread(confirm_stripe_payment, payment_intent_id)
+    
+    if result["success"]:
+        paid_user_id = result.get("user_id")
+        if paid_user_id:
+            await _invalidate_payment_cache(paid_user_id)
+    
+    logger.debug("Результат подтверждения платежа %s: %s", payment_intent_id, result)
+    return ORJSONResponse(result)
 
 # Эндпоинт для получения статистики платежей
-@payments_router.get("/stats/{user_id}", response_model=dict)
+@payments_router.get("/stats/{user_id}", response_model=None)
 async def get_payment_stats(user_id: int):
     """
     Получение статистики платежей пользователя
@@ -232,20 +315,26 @@ async def get_payment_stats(user_id: int):
     Returns:
         Статистика по транзакциям пользователя
     """
-    try:
-        logger.info(f"Запрос статистики для пользователя {user_id}")
-        
-        transactions = get_user_transactions(str(user_id))
-        balance = get_user_balance(str(user_id))
-        
-        # Подсчитываем статистику
-        total_transactions = len(transactions)
-        successful_transactions = len([tx for tx in transactions if tx['status'] == 'completed'])
-        failed_transactions = len([tx for tx in transactions if tx['status'] == 'failed'])
-        pending_transactions = len([tx for tx in transactions if tx['status'] == 'pending'])
+    logger.info("Запрос статистики для пользователя %s", user_id)
+    
+    async def load():
+        # Итоги по статусам и баланс берутся из агрегатов Ledger за O(1),
+        # без выборки истории транзакций; чтение в потоках, как и другие
+        # обращения к Ledger, чтобы ожидание его блокировки не останавливало цикл событий
+        uid = str(user_id)
+        by_status, balance = await asyncio.gather(
+            asyncio.to_thread(get_user_transaction_stats, uid),
+            asyncio.to_thread(get_user_balance, uid)
+        )
         
-        total_amount = sum(tx['gross'] for tx in transactions)
-        successful_amount = sum(tx['gross'] for tx in transactions if tx['status'] == 'completed')
+        successful_transactions, successful_amount = by_status.get('completed', (0, 0.0))
+        failed_transactions = by_status.get('failed', (0, 0.0))[0]
+        pending_transactions = by_status.get('pending', (0, 0.0))[0]
+        total_transactions = 0
+        total_amount = 0.0
+        for count, gross in by_status.values():
+            total_transactions += count
+            total_amount += gross
         
         stats = {
             "user_id": user_id,
@@ -265,18 +354,16 @@ async def get_payment_stats(user_id: int):
             "message": f"Статистика для пользователя {user_id} успешно получена"
         }
         
-        logger.info(f"Статистика для пользователя {user_id}: {total_transactions} транзакций")
+        logger.info("Статистика для пользователя %s: %s транзакций", user_id, total_transactions)
         return stats
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения статистики для пользователя {user_id}: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка получения статистики: {str(e)}"
-        )
+    
+    payload = await cache.get_or_set(
+        cache.payment_stats_key(user_id), cache.PAYMENT_STATS_TTL, load
+    )
+    return Response(payload, media_type="application/json")
 
 # Эндпоинт для проверки статуса платежной системы
-@payments_router.get("/health", response_model=dict)
+@payments_router.get("/health", response_model=None)
 async def payments_health_check():
     """
     Проверка состояния платежной системы
@@ -284,34 +371,8 @@ async def payments_health_check():
     Returns:
         Статус платежной системы и доступных сервисов
     """
-    try:
-        import os
-        from payments.payments import STRIPE_AVAILABLE, STRIPE_INITIALIZED
-        
-        health_status = {
-            "status": "healthy",
-            "timestamp": "2024-01-01T00:00:00Z",  # Можно добавить datetime.now().isoformat()
-            "services": {
-                "stripe_api": {
-                    "available": STRIPE_AVAILABLE,
-                    "initialized": STRIPE_INITIALIZED,
-                    "secret_key_configured": bool(os.getenv('STRIPE_SECRET_KEY'))
-                },
-                "ledger": {
-                    "available": True,
-                    "status": "operational"
-                }
-            },
-            "message": "Платежная система работает нормально"
-        }
-        
-        logger.info("Проверка состояния платежной системы: OK")
-        return health_status
-        
-    except Exception as e:
-        logger.error(f"Ошибка проверки состояния платежной системы: {e}")
-        return {
-            "status": "unhealthy",
-            "error": str(e),
-            "message": "Платежная система недоступна"
-        }
+    health_status = _HEALTH_TEMPLATE.copy()
+    health_status["timestamp"] = datetime.now(timezone.utc).isoformat()
+    
+    logger.debug("Проверка состояния платежной системы: OK")
+    return ORJSONResponse(health_status)
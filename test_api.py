@@ -4,12 +4,15 @@
 """
 
 import requests
-import json
+import orjson
 import time
 from typing import Dict, Any
 
 BASE_URL = "http://localhost:8000"
 
+# Одна сессия на все тесты: соединение с сервером переиспользуется (keep-alive)
+SESSION = requests.Session()
+
 def test_api_endpoint(method: str, endpoint: str, data: Dict[Any, Any] = None) -> Dict[Any, Any]:
     """
     Универсальная функция для тестирования API эндпоинтов
@@ -26,17 +29,17 @@ def test_api_endpoint(method: str, endpoint: str, data: Dict[Any, Any] = None) -
     
     try:
         if method.upper() == "GET":
-            response = requests.get(url)
+            response = SESSION.get(url)
         elif method.upper() == "POST":
-            response = requests.post(url, json=data)
+            response = SESSION.post(url, json=data)
         elif method.upper() == "PUT":
-            response = requests.put(url, json=data)
+            response = SESSION.put(url, json=data)
         else:
             return {"error": f"Неподдерживаемый метод: {method}"}
         
         return {
             "status_code": response.status_code,
-            "data": response.json() if response.content else None,
+            "data": orjson.loads(response.content) if response.content else None,
             "success": response.status_code < 400
         }
         
@@ -60,7 +63,7 @@ def print_result(test_name: str, result: Dict[Any, Any]):
     
     if result["data"]:
         print("Ответ:")
-        print(json.dumps(result["data"], indent=2, ensure_ascii=False))
+        print(orjson.dumps(result["data"], option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode())
 
 def main():
     """Основная функция тестирования"""
@@ -155,7 +158,7 @@ def test_error_scenarios():
     
     # Тест 1: Неверный JSON
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{BASE_URL}/users/888999000",
             data="invalid json",
             headers={"Content-Type": "application/json"}
@@ -176,9 +179,10 @@ def test_error_scenarios():
 
 if __name__ == "__main__":
     print("Инструкции:")
-    print("1. Запустите сервер: uvicorn app:app --reload")
-    print("2. Убедитесь, что база данных настроена в .env файле")
-    print("3. Запустите тесты: python test_api.py")
+    print("1. Примените миграции: python migrate.py")
+    print("2. Запустите сервер: uvicorn app:app --reload")
+    print("3. Убедитесь, что база данных настроена в .env файле")
+    print("4. Запустите тесты: python test_api.py")
     print("\n" + "="*60 + "\n")
     
     # Основные тесты